@@ -6,82 +6,232 @@ Multi-feedback Pairwise Ranking via Adversarial Training for Recommender
 from __future__ import absolute_import
 from __future__ import division
 import os
+import sys
 import math
+import json
+import pickle
 import logging
 import argparse
 import numpy as np
-import pandas as pd
-import tensorflow as tf
 from multiprocessing import Pool
+from multiprocessing import Queue
+from multiprocessing import Process
 from multiprocessing import cpu_count
+from multiprocessing import Barrier
+from multiprocessing import RawArray
+from queue import Empty
+from collections import OrderedDict
 
 from time import time
 from time import strftime
 from time import localtime
 
-from utility.get_batch import *
-from utility.sampling import *
-from utility.load_data import Data
+from utility.get_batch import get_channels, get_pos_neg_splits, get_overall_level_distributions, \
+    get_pos_level_dist, get_pos_channel_item_dict, get_pos_channel_item_index, update_pos_channel_item_dict, \
+    get_user_rep, get_user_reps, update_user_reps
+from utility.sampling import get_pos_channel, get_pos_user_item, get_neg_item, get_pos_channel_sampler, \
+    get_neg_channel_sampler, update_neg_channel_sampler, draw_pos_channels, draw_neg_channels, \
+    get_neg_channel_cdf, draw_neg_channels_cdf
+from utility import metrics
 
+# TensorFlow and pandas are imported by the code paths that need them,
+# so that --help and prepare do not pay for the import
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+tf = None
+COMMANDS = ['prepare', 'train', 'evaluate', 'recommend', 'sweep']
 _user_input = None
 _item_input_pos = None
 _batch_size = None
-_index = None
 _model = None
 _sess = None
 _dataset = None
 _K = None
 _feed_dict = None
+_train_items = None
 _output = None
+_focus_users = None
+_focus = 0
+_profiled_epochs = 0
+_rank = 0
+_shared = None
+_barrier = None
+_own_pos = None
+
+
+def parse_args(argv=None):
+    # the dataset and run options of every command
+    data = argparse.ArgumentParser(add_help=False)
+    data.add_argument('--path', nargs='?', default='Data/',
+                      help='Input data path.')
+    data.add_argument('--dataset', nargs='?', default='yelp',
+                      help='Choose a dataset.')
+    data.add_argument('--task', nargs='?', default='',
+                      help='Add the task name for launching experiments')
+    data.add_argument('--metrics', type=str, default=None,
+                      help='Write timers, counters and peak RSS of the run to this JSONL file.')
+    data.add_argument('--out_of_core', action='store_true',
+                      help='Train from user-sorted, memory-mapped shards of the rating files instead of memory.')
+    data.add_argument('--shard_users', type=int, default=100000,
+                      help='Users per shard of --out_of_core, bounds the memory of the ingest sort.')
+    data.add_argument('--chunk_rows', type=int, default=1000000,
+                      help='Rows per chunk when --out_of_core streams the rating files.')
+
+    # the options of the commands that restore or save a model
+    model = argparse.ArgumentParser(add_help=False)
+    model.add_argument('--embed_size', type=int, default=64,
+                       help='Embedding size.')
+
+    # the options of the commands that train
+    training = argparse.ArgumentParser(add_help=False)
+    training.add_argument('--verbose', type=int, default=1,
+                          help='Evaluate per X epochs.')
+    training.add_argument('--batch_size', type=int, default=512,
+                          help='batch_size')
+    training.add_argument('--epochs', type=int, default=2000,
+                          help='Number of epochs.')
+    training.add_argument('--dns', type=int, default=1,
+                          help='number of negative sample for each positive in dns.')
+    training.add_argument('--reg', type=float, default=0,
+                          help='Regularization for user and item embeddings.')
+    training.add_argument('--lr', type=float, default=0.05,
+                          help='Learning rate.')
+    training.add_argument('--reg_adv', type=float, default=1,
+                          help='Regularization for adversarial loss')
+    training.add_argument('--max_verbose', type=int, default=0,
+                          help='Double the evaluation interval up to X epochs while NDCG does not improve, '
+                               '--verbose is restored on improvement. 0 keeps evaluating per --verbose epochs.')
+    training.add_argument('--patience', type=int, default=0,
+                          help='Stop a phase after X evaluations without NDCG improvement, 0 trains all epochs. '
+                               'The MPR phase only stops early when it is the last phase or with --auto_adv.')
+    training.add_argument('--min_delta', type=float, default=0.0,
+                          help='Smallest NDCG gain that counts as an improvement for --patience and --max_verbose.')
+    training.add_argument('--auto_adv', action='store_true',
+                          help='Start AT-MPR when MPR stops improving (--patience), --adv_epoch is the latest start.')
+    training.add_argument('--ckpt', type=int, default=100,
+                          help='Save the model per X epochs.')
+    training.add_argument('--adv_epoch', type=int, default=0,
+                          help='Add AT-MPR in epoch X, when adv_epoch is 0, it\'s equivalent to pure AT-MPR.\n '
+                               'And when adv_epoch is larger than epochs, it\'s equivalent to pure MF-BPR model. ')
+    training.add_argument('--adv', nargs='?', default='grad',
+                          help='Generate the adversarial sample by gradient method or random method')
+    training.add_argument('--eps', type=float, default=0.5,
+                          help='Epsilon for adversarial weights.')
+    training.add_argument('--adv_refresh', type=int, default=1,
+                          help='Recompute the adversarial perturbation every X batches from the gradient over '
+                               'these X batches, 0 once per epoch.')
+    training.add_argument('--adv_accumulate', action='store_true',
+                          help='Refresh the perturbation from the clean-loss gradients of the train steps of the '
+                               'previous --adv_refresh window instead of an extra gradient pass (--adv grad). '
+                               'The perturbation then lags a window and covers the rows of that window only.')
+    training.add_argument('--sampling', dest="neg_sampling_modes", type=str, default='non-uniform',
+                          help="list of negative item sampling modes")
+    training.add_argument('--profile', type=int, default=0,
+                          help='Profile the first X training epochs with cProfile, the stats go to ../Log.')
 
-
-def parse_args():
     parser = argparse.ArgumentParser(description="Multi-feedback Pairwise Ranking via Adversarial Training for Recommender")
-    parser.add_argument('--path', nargs='?', default='Data/',
-                        help='Input data path.')
-    parser.add_argument('--dataset', nargs='?', default='yelp',
-                        help='Choose a dataset.')
-    parser.add_argument('--verbose', type=int, default=1,
-                        help='Evaluate per X epochs.')
-    parser.add_argument('--batch_size', type=int, default=512,
-                        help='batch_size')
-    parser.add_argument('--epochs', type=int, default=2000,
-                        help='Number of epochs.')
-    parser.add_argument('--embed_size', type=int, default=64,
-                        help='Embedding size.')
-    parser.add_argument('--dns', type=int, default=1,
-                        help='number of negative sample for each positive in dns.')
-    parser.add_argument('--reg', type=float, default=0,
-                        help='Regularization for user and item embeddings.')
-    parser.add_argument('--lr', type=float, default=0.05,
-                        help='Learning rate.')
-    parser.add_argument('--reg_adv', type=float, default=1,
-                        help='Regularization for adversarial loss')
-    parser.add_argument('--restore', type=str, default=None,
-                        help='The restore time_stamp for weights in \Pretrain')
-    parser.add_argument('--ckpt', type=int, default=100,
-                        help='Save the model per X epochs.')
-    parser.add_argument('--task', nargs='?', default='',
-                        help='Add the task name for launching experiments')
-    parser.add_argument('--adv_epoch', type=int, default=0,
-                        help='Add AT-MPR in epoch X, when adv_epoch is 0, it\'s equivalent to pure AT-MPR.\n '
-                             'And when adv_epoch is larger than epochs, it\'s equivalent to pure MF-BPR model. ')
-    parser.add_argument('--adv', nargs='?', default='grad',
-                        help='Generate the adversarial sample by gradient method or random method')
-    parser.add_argument('--eps', type=float, default=0.5,
-                        help='Epsilon for adversarial weights.')
-    parser.add_argument('--beta', type=float, default=0.8,
-                        help='share of unobserved within negative feedback')
-    parser.add_argument('--sampling', dest="neg_sampling_modes", type=str, default='non-uniform',
-                        help="list of negative item sampling modes")
-    return parser.parse_args()
+    subparsers = parser.add_subparsers(dest='command')
+    prepare_parser = subparsers.add_parser('prepare', parents=[data],
+                                           help='Build the dataset and sampling context cache used by the other '
+                                                'commands.')
+    train_parser = subparsers.add_parser('train', parents=[data, model, training],
+                                         help='Train MPR then AT-MPR, or fold --update into the model of --restore.')
+    evaluate_parser = subparsers.add_parser('evaluate', parents=[data, model],
+                                            help='Evaluate the model of --restore.')
+    recommend_parser = subparsers.add_parser('recommend', parents=[data, model],
+                                             help='Recommend the top items with the model of --restore.')
+    sweep_parser = subparsers.add_parser('sweep', parents=[data, model, training],
+                                         help='Train a grid of settings on one loaded dataset.')
+
+    for command_parser in [train_parser, evaluate_parser, recommend_parser]:
+        command_parser.add_argument('--restore', type=str, default=None,
+                                    help='The restore time_stamp for weights in \Pretrain')
+    for command_parser in [prepare_parser, train_parser, sweep_parser]:
+        command_parser.add_argument('--beta', type=float, default=0.8,
+                                    help='share of unobserved within negative feedback')
+    for command_parser in [train_parser, evaluate_parser, sweep_parser]:
+        command_parser.add_argument('--workers', type=int, default=cpu_count(),
+                                    help='Number of processes that generate batches and evaluation inputs, '
+                                         '1 runs inline. Split between the --trainers.')
+
+    train_parser.add_argument('--update', type=str, default=None,
+                              help='Rating file with new interactions to fold into the model restored by --restore.')
+    train_parser.add_argument('--update_epochs', type=int, default=5,
+                              help='Number of focused epochs to run after folding in --update.')
+    train_parser.add_argument('--focus', type=float, default=0.8,
+                              help='Share of the focused epochs sampled from the users affected by --update.')
+    train_parser.add_argument('--trainers', type=int, default=1,
+                              help='Data-parallel trainer processes, each owns the users u with u %% trainers == rank '
+                                   'and the item embeddings are averaged between them.')
+    train_parser.add_argument('--sync_every', type=int, default=0,
+                              help='Average the item embeddings of the --trainers every X batches, 0 once per epoch.')
+
+    for command_parser in [evaluate_parser, recommend_parser]:
+        command_parser.add_argument('--phase', nargs='?', default=None,
+                                    help='Restore the online, AT-MPR or MPR weights, the latest phase by default.')
+    evaluate_parser.add_argument('--topk', type=int, default=100,
+                                 help='Report HR and NDCG at K (at most 100).')
+    recommend_parser.add_argument('--topk', type=int, default=10,
+                                  help='Number of recommended items per user.')
+    recommend_parser.add_argument('--users', type=int, nargs='*', default=None,
+                                  help='Raw user IDs to recommend for, all users by default.')
+    recommend_parser.add_argument('--output', type=str, default=None,
+                                  help='Write the recommendations to this file instead of stdout.')
+    for name, value_type in [('eps', float), ('reg_adv', float), ('beta', float), ('lr', float), ('sampling', str)]:
+        sweep_parser.add_argument('--%s_grid' % name, type=value_type, nargs='+', default=None,
+                                  help='Values of --%s to sweep, the single --%s value by default.' % (name, name))
+    sweep_parser.add_argument('--jobs', type=int, default=1,
+                              help='Number of trials trained in parallel, each uses --workers batch processes.')
+    sweep_parser.add_argument('--table', type=str, default=None,
+                              help='Result table (TSV), ../Log/<dataset>_sweep_<time_stamp>.tsv by default.')
+
+    # a command rejects the options of the others, they keep their defaults, e.g. for the model of evaluate
+    defaults = {}
+    for command in COMMANDS:
+        defaults.update(vars(subparsers.choices[command].parse_args([])))
+    for command in COMMANDS:
+        command_parser = subparsers.choices[command]
+        own = vars(command_parser.parse_args([]))
+        command_parser.set_defaults(**{key: value for key, value in defaults.items() if key not in own})
+
+    # without a command, e.g. `AT-MPR.py --dataset ml-1m`, train as before
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['train'] + argv
+    args = parser.parse_args(argv)
+    if args.auto_adv and args.patience <= 0:
+        parser.error('--auto_adv needs --patience to detect the MPR plateau')
+    if args.adv_refresh < 0:
+        parser.error('--adv_refresh must be 0 (per epoch) or a number of batches')
+    if args.adv_accumulate and args.adv != 'grad':
+        parser.error('--adv_accumulate needs the gradient-based perturbation (--adv grad)')
+    return args
+
+
+def _import_tensorflow():
+    global tf
+    if tf is None:
+        import tensorflow
+        tf = tensorflow
+    return tf
+
+# map func over a pool of args.workers processes, inline for a single worker
+def _pool_map(func, iterable):
+    if args.workers <= 1:
+        return list(map(func, iterable))
+    pool = Pool(args.workers)
+    res = pool.map(func, iterable)
+    pool.close()
+    pool.join()
+    return res
 
 # data sampling and shuffling
 
 # input: dataset(Mat, List, Rating, Negatives), batch_choice, num_negatives
 # output: [_user_input_list, _item_input_pos_list]
 def sampling(dataset):
+    if args.out_of_core:
+        # only the no. of positive pairs sets the epoch length, the pairs stay on disk
+        return range(dataset.num_pairs), range(dataset.num_pairs)
     _user_input, _item_input_pos = [], []
     for (u, i) in dataset.trainMatrix.keys():
         # positive instance
@@ -90,43 +240,123 @@ def sampling(dataset):
     return _user_input, _item_input_pos
 
 
-def shuffle(samples, batch_size, dataset, model):
+def init_sampling(dataset, args, context=None):
+    global channels
+    global train_inter_pos, train_inter_neg
+    global pos_level_dist, neg_level_dist
+    global train_inter_pos_dict, train_inter_pos_index, user_reps
+    global pos_channel_sampler, neg_channel_sampler
+
+    begin_time = time()
+    train_inter_pos_index = None
+    if context is not None:
+        # built by `prepare`, or saved with an online checkpoint together with the index of its updates
+        channels, pos_level_dist = context['channels'], context['pos_level_dist']
+        train_inter_pos_dict, user_reps = context['train_inter_pos_dict'], context['user_reps']
+        pos_channel_sampler, neg_channel_sampler = context['pos_channel_sampler'], context['neg_channel_sampler']
+        train_inter_pos_index = context.get('train_inter_pos_index')
+        return
+
+    if args.out_of_core:
+        # from the per-user statistics of the shard store, there are no user_reps
+        channels = list(dataset.channels)
+        pos_level_dist = get_pos_level_dist(*dataset.get_pos_channel_counts())
+        train_inter_pos_dict, user_reps = None, None
+        pos_channel_sampler = get_pos_channel_sampler(pos_level_dist)
+        neg_channel_sampler = get_neg_channel_cdf(dataset.channels, dataset.counts, dataset.mean_ratings, args.beta)
+        print("Load the sampling context done [%.1f s]" % (time() - begin_time))
+        return
+
+    channels = get_channels(dataset.trainList)
+    train_inter_pos, train_inter_neg = get_pos_neg_splits(dataset.trainList)
+    pos_level_dist, _ = get_overall_level_distributions(train_inter_pos, train_inter_neg, args.beta)
+    train_inter_pos_dict = get_pos_channel_item_dict(train_inter_pos)
+    # the model has its own embeddings, the reps (also cached by `prepare`) need no latent features
+    user_reps = get_user_reps(dataset.num_users, 0, dataset.trainList,
+                              dataset.testRatings, channels, args.beta)
+
+    # compile the channel distributions once, every draw is O(1) afterwards
+    pos_channel_sampler = get_pos_channel_sampler(pos_level_dist)
+    neg_channel_sampler = get_neg_channel_sampler(user_reps, dataset.num_users)
+    print("Load the sampling context done [%.1f s]" % (time() - begin_time))
+
+
+def get_sampling_context():
+    return {'channels': channels, 'pos_level_dist': pos_level_dist,
+            'train_inter_pos_dict': train_inter_pos_dict, 'user_reps': user_reps,
+            'pos_channel_sampler': pos_channel_sampler, 'neg_channel_sampler': neg_channel_sampler,
+            'train_inter_pos_index': train_inter_pos_index}
+
+
+# input: dataset, new_ratings (DataFrame with raw [user, item, rating])
+# output: list of the affected (dense) users
+def update_sampling(dataset, new_ratings, args):
+    global channels
+    global pos_level_dist
+    global train_inter_pos_index
+    global pos_channel_sampler
+
+    num_users = dataset.num_users
+    new_ratings = dataset.append_ratings(new_ratings)
+    channels = sorted(set(channels).union(new_ratings['rating'].unique()), reverse=True)
+
+    # built on the first update only, later updates move single tuples
+    if train_inter_pos_index is None:
+        train_inter_pos_index = get_pos_channel_item_index(train_inter_pos_dict)
+
+    old_reps = update_user_reps(user_reps, new_ratings, 0, channels, args.beta)
+    for u, old_rep in old_reps.items():
+        update_pos_channel_item_dict(train_inter_pos_dict, train_inter_pos_index, u, old_rep, user_reps[u])
+
+    # users that never rated anything still need a representation
+    new_users = [u for u in range(num_users, dataset.num_users) if u not in user_reps]
+    for u in new_users:
+        user_reps[u] = get_user_rep(0, [], [], [], channels, args.beta)
+
+    levels = np.array(list(train_inter_pos_dict.keys()))
+    counts = np.array([len(train_inter_pos_dict[key]) for key in levels])
+    pos_level_dist = get_pos_level_dist(levels, counts)
+    pos_channel_sampler = get_pos_channel_sampler(pos_level_dist)
+    update_neg_channel_sampler(neg_channel_sampler, user_reps, list(old_reps.keys()) + new_users)
+
+    return sorted(old_reps.keys())
+
+
+# input: dataset, rank, trainers
+# do: restrict the positive pairs of the batches to the users u with u % trainers == rank,
+#     the unobserved negatives are still drawn from the positives of all users
+def partition_sampling(dataset, rank, trainers):
+    global _own_pos
+
+    if args.out_of_core:
+        dataset.partition_users(np.arange(dataset.num_users) % trainers == rank)
+        own_pos_dict, own_level_dist = None, get_pos_level_dist(*dataset.get_pos_channel_counts(own=True))
+    else:
+        partition = [(key, [(u, i) for u, i in u_i_tuples if u % trainers == rank])
+                     for key, u_i_tuples in train_inter_pos_dict.items()]
+        own_pos_dict = OrderedDict((key, u_i_tuples) for key, u_i_tuples in partition if u_i_tuples)
+        levels = np.array(list(own_pos_dict.keys()))
+        counts = np.array([len(own_pos_dict[key]) for key in levels])
+        own_level_dist = get_pos_level_dist(levels, counts)
+    _own_pos = own_pos_dict, get_pos_channel_sampler(own_level_dist)
+
+
+def shuffle(samples, batch_size, dataset, model, num_batch=None):
     global _user_input
     global _item_input_pos
     global _batch_size
-    global _index
     global _model
     global _dataset
 
-    global train_inter_pos, train_inter_neg
-    global pos_level_dist, neg_level_dist
-    global train_inter_pos_dict, user_reps
-
     _user_input, _item_input_pos = samples
     _batch_size = batch_size
-    _index = list(range(len(_user_input)))
     _model = model
     _dataset = dataset
 
-    channels = get_channels(_dataset.trainList)
-    train_inter_pos, train_inter_neg = get_pos_neg_splits(_dataset.trainList)
-    pos_level_dist, _ = get_overall_level_distributions(train_inter_pos, train_inter_neg, args.beta)
-    train_inter_pos_dict = get_pos_channel_item_dict(train_inter_pos)  
-    user_reps = get_user_reps(_dataset.num_users, args.embed_size, _dataset.trainList, 
-                              _dataset.testRatings, channels, args.beta)  
-    
-    np.random.shuffle(_index)
-    num_batch = len(_user_input) // _batch_size
+    if num_batch is None:
+        num_batch = len(_user_input) // _batch_size
     
-    # res = []
-    # for i in range(num_batch):
-    #     temp = _get_train_batch(i)
-    #     res.append(temp)
-        
-    pool = Pool(cpu_count())
-    res = pool.map(_get_train_batch, range(num_batch))
-    pool.close()
-    pool.join()
+    res = _pool_map(_get_train_batch, range(num_batch))
     
     user_list = [r[0] for r in res]
     item_pos_list = [r[1] for r in res]
@@ -136,28 +366,51 @@ def shuffle(samples, batch_size, dataset, model):
 
 
 def _get_train_batch(i):
+    if args.out_of_core:
+        return _get_shard_batch(i)
     user_batch, item_batch = [], []
-    user_neg_batch, item_neg_batch = [], []
-    begin = i * _batch_size
-    for idx in range(begin, begin + _batch_size):
-        L = get_pos_channel(pos_level_dist)
-        u, i = get_pos_user_item(L, train_inter_pos_dict)
+    item_neg_batch = []
+    # a data-parallel trainer draws the positives of its own users
+    pos_dict, pos_sampler = _own_pos if _own_pos is not None else (train_inter_pos_dict, pos_channel_sampler)
+    # draw the positive channels of the whole batch from the alias table
+    pos_channels = draw_pos_channels(pos_sampler, _batch_size)
+    for idx in range(_batch_size):
+        if _focus_users is not None and np.random.random() < _focus:
+            # focused epochs: positives of the users affected by an update
+            u = _focus_users[np.random.randint(len(_focus_users))]
+            L = get_pos_channel(user_reps[u]['pos_channel_dist'])
+            pos_items = user_reps[u]['pos_channel_items'][L]
+            i = pos_items[np.random.randint(len(pos_items))]
+        else:
+            u, i = get_pos_user_item(pos_channels[idx], pos_dict)
         user_batch.append(u)
         item_batch.append(i)
 
-        for dns in range(_model.dns):
-            user_neg_batch.append(u)
-            # negtive k
-            
-            N = get_neg_channel(user_reps[u])
-            j = get_neg_item(user_reps[u], N, _dataset.num_items, u, i,
-                             pos_level_dist, train_inter_pos_dict, 
-                             args.neg_sampling_modes)
-            item_neg_batch.append(j)
+    # negtive k, _model.dns per positive
+    user_neg_batch = np.repeat(user_batch, _model.dns)
+    neg_channels = draw_neg_channels(neg_channel_sampler, user_neg_batch)
+    for idx, (u, N) in enumerate(zip(user_neg_batch, neg_channels)):
+        j = get_neg_item(user_reps[u], N, _dataset.num_items, u, item_batch[idx // _model.dns],
+                         pos_level_dist, train_inter_pos_dict,
+                         args.neg_sampling_modes, pos_channel_sampler)
+        item_neg_batch.append(j)
     return np.asarray(user_batch)[:, None], np.asarray(item_batch)[:, None], \
            np.asarray(user_neg_batch)[:, None], np.asarray(item_neg_batch)[:, None]
 
 
+# the whole batch is drawn at once from the memory-mapped shards
+def _get_shard_batch(i):
+    pos_sampler = _own_pos[1] if _own_pos is not None else pos_channel_sampler
+    pos_channels = _dataset.channel_levels(draw_pos_channels(pos_sampler, _batch_size))
+    user_batch, item_batch = _dataset.draw_pos_pairs(pos_channels, own=_own_pos is not None)
+
+    user_neg_batch = np.repeat(user_batch, _model.dns)
+    neg_channels = draw_neg_channels_cdf(neg_channel_sampler, user_neg_batch)
+    item_neg_batch = _dataset.draw_neg_items(user_neg_batch, neg_channels, args.neg_sampling_modes,
+                                             pos_channel_sampler)
+    return user_batch[:, None], item_batch[:, None], user_neg_batch[:, None], item_neg_batch[:, None]
+
+
 # prediction model
 class MF:
     def __init__(self, num_users, num_items, args):
@@ -169,9 +422,12 @@ class MF:
         self.dns = args.dns
         self.adv = args.adv
         self.eps = args.eps
-        self.adver = args.adver
         self.reg_adv = args.reg_adv
         self.epochs = args.epochs
+        self.adv_refresh = args.adv_refresh
+        self.adv_accumulate = args.adv_accumulate
+        # whether the accumulators hold the gradients of a full --adv_refresh window
+        self.accumulated = False
 
     def _create_placeholders(self):
         with tf.name_scope("input_data"):
@@ -225,18 +481,26 @@ class MF:
             self.loss = tf.reduce_sum(tf.nn.softplus(-self.result))
 
             # loss to be omptimized
-            self.opt_loss = self.loss + self.reg * \
+            self.reg_loss = self.reg * \
                     tf.reduce_mean(tf.square(embed_p_pos) + tf.square(embed_q_pos) + tf.square(embed_q_neg)) # embed_p_pos == embed_q_neg
-
-            if self.adver:
-                # loss for L(Theta + adv_Delta)
-                self.output_adv, embed_p_pos, embed_q_pos = self._create_inference_adv(self.item_input_pos)
-                self.output_neg_adv, embed_p_neg, embed_q_neg = self._create_inference_adv(self.item_input_neg)
-                self.result_adv = tf.clip_by_value(self.output_adv - self.output_neg_adv, -80.0, 1e8)
-                # self.loss_adv = tf.reduce_sum(tf.log(1 + tf.exp(-self.result_adv)))
-                self.loss_adv = tf.reduce_sum(tf.nn.softplus(-self.result_adv))
-                self.opt_loss += self.reg_adv * self.loss_adv + \
-                                 self.reg * tf.reduce_mean(tf.square(embed_p_pos) + tf.square(embed_q_pos) + tf.square(embed_q_neg))
+            self.opt_loss = self.loss + self.reg_loss
+
+            # loss for L(Theta + adv_Delta), both losses share the same variables
+            self.output_adv, embed_p_pos, embed_q_pos = self._create_inference_adv(self.item_input_pos)
+            self.output_neg_adv, embed_p_neg, embed_q_neg = self._create_inference_adv(self.item_input_neg)
+            self.result_adv = tf.clip_by_value(self.output_adv - self.output_neg_adv, -80.0, 1e8)
+            # self.loss_adv = tf.reduce_sum(tf.log(1 + tf.exp(-self.result_adv)))
+            self.loss_adv = tf.reduce_sum(tf.nn.softplus(-self.result_adv))
+            self.reg_loss_adv = self.reg * tf.reduce_mean(tf.square(embed_p_pos) + tf.square(embed_q_pos) + tf.square(embed_q_neg))
+            self.opt_loss_adv = self.opt_loss + self.reg_adv * self.loss_adv + self.reg_loss_adv
+
+    @staticmethod
+    def _add_grads(grad, rest):
+        # sparse gradients are concatenated, the optimizer sums up the repeated rows
+        if isinstance(grad, tf.IndexedSlices) and isinstance(rest, tf.IndexedSlices):
+            return tf.IndexedSlices(tf.concat([grad.values, rest.values], 0),
+                                    tf.concat([grad.indices, rest.indices], 0), grad.dense_shape)
+        return tf.convert_to_tensor(grad) + tf.convert_to_tensor(rest)
 
     def _create_adversarial(self):
         with tf.name_scope("adversarial"):
@@ -264,9 +528,46 @@ class MF:
                 self.update_P = self.delta_P.assign(tf.nn.l2_normalize(self.grad_P_dense, 1) * self.eps)
                 self.update_Q = self.delta_Q.assign(tf.nn.l2_normalize(self.grad_Q_dense, 1) * self.eps)
 
+                # --adv_accumulate: the train steps sum up the gradients of the clean loss they computed
+                # anyway, a refresh turns the sums into the perturbation and resets them. The
+                # perturbation covers the rows of the previous window, the others stay unperturbed
+                if self.adv_accumulate:
+                    self.accum_P = tf.Variable(tf.zeros(shape=[self.num_users, self.embedding_size]),
+                                               name='accum_P', dtype=tf.float32, trainable=False)
+                    self.accum_Q = tf.Variable(tf.zeros(shape=[self.num_items, self.embedding_size]),
+                                               name='accum_Q', dtype=tf.float32, trainable=False)
+                    self.accumulate = [self._accumulate(self.accum_P, self.grad_loss[0]),
+                                       self._accumulate(self.accum_Q, self.grad_loss[1])]
+
+                    refresh_P = self.delta_P.assign(tf.nn.l2_normalize(self.accum_P, 1) * self.eps)
+                    refresh_Q = self.delta_Q.assign(tf.nn.l2_normalize(self.accum_Q, 1) * self.eps)
+                    with tf.control_dependencies([refresh_P, refresh_Q]):
+                        self.refresh_delta = tf.group(self.accum_P.assign(tf.zeros_like(self.accum_P)),
+                                                      self.accum_Q.assign(tf.zeros_like(self.accum_Q)))
+
+    @staticmethod
+    def _accumulate(accum, grad):
+        # the gradients of embedding lookups are sparse, only the looked up rows are added
+        if isinstance(grad, tf.IndexedSlices):
+            return tf.scatter_add(accum, grad.indices, grad.values)
+        return accum.assign_add(grad)
+
     def _create_optimizer(self):
         with tf.name_scope("optimizer"):
-            self.optimizer = tf.train.AdagradOptimizer(learning_rate=self.learning_rate).minimize(self.opt_loss)
+            # one optimizer instance, so MPR and AT-MPR train ops share the Adagrad accumulators
+            self.adagrad = tf.train.AdagradOptimizer(learning_rate=self.learning_rate)
+            self.optimizer = self.adagrad.minimize(self.opt_loss)
+            if self.adv_accumulate:
+                # the gradient of the clean loss is computed apart from the rest of opt_loss_adv and
+                # applied together with it, so that --adv_accumulate sums it up without another backward pass
+                variables = [self.embedding_P, self.embedding_Q]
+                self.grad_loss = tf.gradients(self.loss, variables)
+                grad_rest = tf.gradients(self.reg_loss + self.reg_adv * self.loss_adv + self.reg_loss_adv, variables)
+                self.optimizer_adv = self.adagrad.apply_gradients(
+                    [(self._add_grads(grad, rest), variable)
+                     for grad, rest, variable in zip(self.grad_loss, grad_rest, variables)])
+            else:
+                self.optimizer_adv = self.adagrad.minimize(self.opt_loss_adv)
             #self.optimizer = tf.train.AdadeltaOptimizer(learning_rate=self.learning_rate).minimize(self.opt_loss)
             #self.optimizer = tf.train.RMSPropOptimizer(learning_rate=self.learning_rate).minimize(self.opt_loss)
 
@@ -279,85 +580,378 @@ class MF:
 
 
 # training
-def training(model, dataset, args, epoch_start, epoch_end, time_stamp):  # saver is an object to save pq
-
-    with tf.Session() as sess:
-        # initialized the save op
-        if args.adver:
-            ckpt_save_path = "../Pretrain/%s/AT-MPR/embed_%d/%s/" % (args.dataset, args.embed_size, time_stamp)
-            ckpt_restore_path = "../Pretrain/%s/MPR/embed_%d/%s/" % (args.dataset, args.embed_size, time_stamp)
-        else:
-            ckpt_save_path = "../Pretrain/%s/MPR/embed_%d/%s/" % (args.dataset, args.embed_size, time_stamp)
-            ckpt_restore_path = 0 if args.restore is None else "../Pretrain/%s/MPR/embed_%d/%s/" % (args.dataset, args.embed_size, args.restore)
-        
-        if not os.path.exists(ckpt_save_path):
-            os.makedirs(ckpt_save_path)
-
-        if ckpt_restore_path and not os.path.exists(ckpt_restore_path):
-            os.makedirs(ckpt_restore_path)
-
-        saver_ckpt = tf.train.Saver({'embedding_P': model.embedding_P, 'embedding_Q': model.embedding_Q})
-
-        # pretrain or not
-        sess.run(tf.global_variables_initializer())
-
-        # restore the weights when pretrained
-        if args.restore is not None or epoch_start:
-            ckpt = tf.train.get_checkpoint_state(os.path.dirname(ckpt_restore_path + 'checkpoint'))
-            if ckpt and ckpt.model_checkpoint_path:
-                saver_ckpt.restore(sess, ckpt.model_checkpoint_path)
-        # initialize the weights
-        else:
-            logging.info("Initialized from scratch")
-            print("Initialized from scratch")
-
-        # initialize for Evaluate
-        eval_feed_dicts = init_eval_model(model, dataset)
-
-        # sample the data
-        samples = sampling(dataset)
-
-        # initialize the max_ndcg to memorize the best result
-        max_ndcg = 0
-        best_res = {}
-
-        # train by epoch
-        global ndcg, cur_res
-        epoch_count = 0
-        for epoch_count in range(epoch_start, epoch_end+1):
-
-            # initialize for training batches
-            batch_begin = time()
+def training(model, sess, dataset, args, samples, eval_feed_dicts, epoch_start, epoch_end, time_stamp):  # saver is an object to save pq
+    # initialized the save op
+    if args.adver:
+        ckpt_save_path = "../Pretrain/%s/AT-MPR/embed_%d/%s/" % (args.dataset, args.embed_size, time_stamp)
+    else:
+        ckpt_save_path = "../Pretrain/%s/MPR/embed_%d/%s/" % (args.dataset, args.embed_size, time_stamp)
+
+    # with --trainers, rank 0 gathers the users of all trainers and writes the files
+    if not os.path.exists(ckpt_save_path) and _rank == 0:
+        os.makedirs(ckpt_save_path)
+
+    saver_ckpt = tf.train.Saver(_checkpoint_state(model))
+    # the checkpoint rows are dense indices, the map turns them back into raw IDs
+    if _rank == 0:
+        dataset.save_id_map(ckpt_save_path + 'id_map.npz')
+
+    # initialize the max_ndcg to memorize the best result, the best state stays in memory
+    max_ndcg = 0
+    best_res = {'stopped': epoch_start - 1}
+    best_state, best_saved = None, True
+
+    # evaluate on the --verbose grid, the interval doubles up to --max_verbose while NDCG is stable,
+    # the phase stops after --patience evaluations without improvement
+    interval = args.verbose
+    next_eval = epoch_start + (-epoch_start) % args.verbose
+    stale_evals, stopped_early = 0, False
+    patience = args.patience if args.adver or args.auto_adv or args.adv_epoch > args.epochs else 0
+
+    # train by epoch
+    global _profiled_epochs
+    epoch_count = epoch_start
+    for epoch_count in range(epoch_start, epoch_end+1):
+        if _profiled_epochs < args.profile:
+            metrics.start_profile()
+
+        # initialize for training batches
+        batch_begin = time()
+        with metrics.timer('batch_generation'):
             batches = shuffle(samples, args.batch_size, dataset, model)
-            batch_time = time() - batch_begin
-
-            # compute the accuracy before training
-            prev_batch = batches[0], batches[1], batches[3]
-            _, prev_acc = training_loss_acc(model, sess, prev_batch, output_adv=0)
-
-            # training the model
-            train_begin = time()
-            train_batches = training_batch(model, sess, batches, args.adver)
-            train_time = time() - train_begin
-
-            if epoch_count % args.verbose == 0:
-                _, ndcg, cur_res = output_evaluate(model, sess, dataset, train_batches, eval_feed_dicts,
-                                                   epoch_count, batch_time, train_time, prev_acc, output_adv=0)
-
-            # print and log the best result
+        batch_time = time() - batch_begin
+
+        # compute the accuracy before training
+        prev_batch = batches[0], batches[1], batches[3]
+        _, prev_acc = training_loss_acc(model, sess, prev_batch, output_adv=0)
+
+        # training the model
+        train_begin = time()
+        train_batches = training_batch(model, sess, batches, args.adver)
+        train_time = time() - train_begin
+
+        best_res['stopped'] = epoch_count
+        evaluated = epoch_count >= next_eval
+        if evaluated:
+            _, ndcg, cur_res = output_evaluate(model, sess, dataset, train_batches, eval_feed_dicts,
+                                               epoch_count, batch_time, train_time, prev_acc, output_adv=0)
+
+            if ndcg > max_ndcg + args.min_delta:
+                stale_evals, interval = 0, args.verbose
+            else:
+                stale_evals, interval = stale_evals + 1, min(2 * interval, max(args.max_verbose, args.verbose))
+            next_eval = epoch_count + interval
+
+            # memorize the best result and state
             if max_ndcg < ndcg:
                 max_ndcg = ndcg
                 best_res['result'] = cur_res
                 best_res['epoch'] = epoch_count
+                _gather_users(model, sess)
+                best_state, best_saved = sess.run(_model_state(model)), False
 
-            if model.epochs == epoch_count:
-                print("Epoch %d is the best epoch" % best_res['epoch'])
+        # save the embedding weights, the best state only when it changed
+        if args.ckpt > 0 and epoch_count % args.ckpt == 0:
+            with metrics.timer('checkpoint'):
+                _gather_users(model, sess)
+                if _rank == 0:
+                    saver_ckpt.save(sess, ckpt_save_path + 'weights', global_step=epoch_count)
+                    if not best_saved:
+                        np.savez(ckpt_save_path + 'best.npz', *best_state)
+                best_saved = True
 
-            # save the embedding weights
-            if args.ckpt > 0 and epoch_count % args.ckpt == 0:
-                saver_ckpt.save(sess, ckpt_save_path + 'weights', global_step=epoch_count)
-
-        saver_ckpt.save(sess, ckpt_save_path + 'weights', global_step=epoch_count)
+        triplets = len(train_batches[0]) * args.batch_size
+        metrics.flush('epoch', phase='AT-MPR' if args.adver else 'MPR', epoch=epoch_count,
+                      batch_time=batch_time, train_time=train_time, triplets_per_sec=triplets / max(train_time, 1e-9),
+                      hr=cur_res[0][-1] if evaluated else None, ndcg=ndcg if evaluated else None)
+
+        if _profiled_epochs < args.profile:
+            _profiled_epochs += 1
+            if _profiled_epochs == args.profile:
+                metrics.stop_profile(args.profile_path)
+
+        if patience > 0 and stale_evals >= patience:
+            print("Stop at epoch %d, NDCG did not improve in %d evaluations" % (epoch_count, stale_evals))
+            logging.info("Stop at epoch %d" % epoch_count)
+            stopped_early = True
+            break
+
+    if 'epoch' in best_res:
+        print("Epoch %d is the best epoch" % best_res['epoch'])
+
+    # an early stopped phase ends with its best state, also the start of the next phase
+    if stopped_early and best_state is not None and best_res['epoch'] < best_res['stopped']:
+        for variable, value in zip(_model_state(model), best_state):
+            variable.load(value, sess)
+
+    with metrics.stage('checkpoint', epoch=epoch_count):
+        _gather_users(model, sess)
+        if _rank == 0:
+            saver_ckpt.save(sess, ckpt_save_path + 'weights', global_step=epoch_count)
+            if not best_saved:
+                np.savez(ckpt_save_path + 'best.npz', *best_state)
+
+    return best_res
+
+
+# the last MPR epoch, --auto_adv trains MPR until it plateaus with --adv_epoch as the latest switch
+def _mpr_epoch_end(args):
+    if args.auto_adv and args.adv_epoch <= 0:
+        return args.epochs
+    return args.adv_epoch - 1
+
+
+# the trained state of a model: embeddings and their Adagrad accumulators
+def _model_state(model):
+    return [model.embedding_P, model.embedding_Q,
+            model.adagrad.get_slot(model.embedding_P, 'accumulator'),
+            model.adagrad.get_slot(model.embedding_Q, 'accumulator')]
+
+
+# the checkpoint names of the trained state
+def _checkpoint_state(model):
+    return dict(zip(['embedding_P', 'embedding_Q', 'embedding_P/Adagrad', 'embedding_Q/Adagrad'], _model_state(model)))
+
+
+# restore the trained state of a checkpoint, checkpoints without the Adagrad accumulators restore the embeddings
+def restore_checkpoint(model, sess, checkpoint_path):
+    names = dict(tf.train.list_variables(checkpoint_path))
+    tf.train.Saver({name: variable for name, variable in _checkpoint_state(model).items() if name in names}).restore(
+        sess, checkpoint_path)
+
+
+def save_snapshot(model, sess, path):
+    np.savez(path, *sess.run(_model_state(model)))
+
+
+def load_snapshot(model, sess, path):
+    snapshot = np.load(path)
+    for k, variable in enumerate(_model_state(model)):
+        variable.load(snapshot['arr_%d' % k], sess)
+
+
+# input: model, sess, the new embedding table sizes
+# output: (model, sess) with larger tables, trained rows and Adagrad accumulators copied over
+def grow_model(model, sess, num_users, num_items, args):
+    old_values = sess.run(_model_state(model))
+    sess.close()
+    tf.reset_default_graph()
+
+    model = MF(num_users, num_items, args)
+    model.build_graph()
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+
+    new_variables = _model_state(model)
+    for variable, old_value, new_value in zip(new_variables, old_values, sess.run(new_variables)):
+        new_value[:old_value.shape[0]] = old_value
+        variable.load(new_value, sess)
+
+    print("Grow the embedding tables to %d users, %d items" % (num_users, num_items))
+    return model, sess
+
+
+# fold new ratings into a trained model and run a few focused epochs,
+# the cost is proportional to the interactions of the affected users
+def online_training(model, sess, dataset, args, new_ratings, time_stamp):
+    global _focus_users
+    global _focus
+
+    update_begin = time()
+    with metrics.stage('sampling_update', ratings=len(new_ratings)):
+        focus_users = update_sampling(dataset, new_ratings, args)
+    if dataset.num_users > model.num_users or dataset.num_items > model.num_items:
+        with metrics.stage('grow_model'):
+            model, sess = grow_model(model, sess, max(dataset.num_users, model.num_users),
+                                     max(dataset.num_items, model.num_items), args)
+    print("Fold in %d ratings of %d users [%.1f s]" % (len(new_ratings), len(focus_users), time() - update_begin))
+
+    # one focused epoch visits the interactions of the affected users about once
+    _focus_users, _focus = np.asarray(focus_users), args.focus
+    num_samples = sum(len(user_reps[u]['items']) for u in focus_users) / max(args.focus, 1e-8)
+    num_batch = max(1, int(math.ceil(num_samples / args.batch_size)))
+    adver = int(args.adv_epoch <= args.epochs)
+
+    for epoch_count in range(args.update_epochs):
+        batch_begin = time()
+        batches = shuffle(([], []), args.batch_size, dataset, model, num_batch=num_batch)
+        batch_time = time() - batch_begin
+
+        train_begin = time()
+        train_batches = training_batch(model, sess, batches, adver)
+        train_time = time() - train_begin
+
+        train_loss, acc = training_loss_acc(model, sess, train_batches, output_adv=0)
+        print("Update epoch %d [%.1fs + %.1fs]: loss = %.4f, ACC = %.4f" %
+              (epoch_count, batch_time, train_time, train_loss, acc))
+        metrics.flush('epoch', phase='online', epoch=epoch_count, batch_time=batch_time, train_time=train_time,
+                      triplets_per_sec=num_batch * args.batch_size / max(train_time, 1e-9), loss=train_loss)
+
+    _focus_users, _focus = None, 0
+
+    ckpt_save_path = "../Pretrain/%s/online/embed_%d/%s/" % (args.dataset, args.embed_size, time_stamp)
+    if not os.path.exists(ckpt_save_path):
+        os.makedirs(ckpt_save_path)
+    # with the Adagrad accumulators, so that the next update does not restart the step sizes
+    saver_ckpt = tf.train.Saver(_checkpoint_state(model))
+    saver_ckpt.save(sess, ckpt_save_path + 'weights', global_step=args.update_epochs)
+    dataset.save_id_map(ckpt_save_path + 'id_map.npz')
+    # the rating files do not hold the folded ratings, the next restore continues from this state
+    with metrics.stage('checkpoint_dataset'):
+        with open(_checkpoint_data_path(ckpt_save_path), 'wb') as f:
+            pickle.dump({'dataset': dataset, 'beta': args.beta, 'context': get_sampling_context()}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+    return model, sess
+
+
+# data-parallel training: `--trainers` forked processes on one machine. Trainer `rank` samples the
+# users u with u % trainers == rank, their embeddings stay local, and the item embeddings and their
+# Adagrad accumulators are averaged through shared memory every --sync_every batches
+def _shared_array(typecode, *shape):
+    dtype = np.float32 if typecode == 'f' else np.float64
+    return np.frombuffer(RawArray(typecode, int(np.prod(shape))), dtype=dtype).reshape(shape)
+
+
+def _item_state(model):
+    return [model.embedding_Q, model.adagrad.get_slot(model.embedding_Q, 'accumulator')]
+
+
+def _user_state(model):
+    return [model.embedding_P, model.adagrad.get_slot(model.embedding_P, 'accumulator')]
+
+
+# all trainers start from the items of rank 0
+def _broadcast_items(model, sess):
+    if _rank == 0:
+        for name, value in zip(['Q_avg', 'Q_acc_avg'], sess.run(_item_state(model))):
+            _shared[name][:] = value
+    _barrier.wait()
+    for variable, name in zip(_item_state(model), ['Q_avg', 'Q_acc_avg']):
+        variable.load(_shared[name], sess)
+    _barrier.wait()
+
+
+# parameter averaging, every trainer reduces a slice of the item rows
+def _sync_items(model, sess):
+    with metrics.timer('sync_items'):
+        for name, value in zip(['Q', 'Q_acc'], sess.run(_item_state(model))):
+            _shared[name][_rank] = value
+        _barrier.wait()
+        rows = slice(_rank * len(_shared['Q_avg']) // args.trainers,
+                     (_rank + 1) * len(_shared['Q_avg']) // args.trainers)
+        for name in ['Q', 'Q_acc']:
+            _shared[name + '_avg'][rows] = _shared[name][:, rows].mean(axis=0)
+        _barrier.wait()
+        for variable, name in zip(_item_state(model), ['Q_avg', 'Q_acc_avg']):
+            variable.load(_shared[name], sess)
+
+
+def _sync_point(model, sess, i, num_batch):
+    if _barrier is None:
+        return
+    if i + 1 == num_batch or (args.sync_every > 0 and (i + 1) % args.sync_every == 0):
+        _sync_items(model, sess)
+
+
+# rank 0 collects the users of all trainers, e.g. before it writes a checkpoint
+def _gather_users(model, sess):
+    if _barrier is None:
+        return
+    owned = slice(_rank, None, args.trainers)
+    for name, value in zip(['P', 'P_acc'], sess.run(_user_state(model))):
+        _shared[name][owned] = value[owned]
+    _barrier.wait()
+    if _rank == 0:
+        for variable, name in zip(_user_state(model), ['P', 'P_acc']):
+            variable.load(_shared[name], sess)
+    _barrier.wait()
+
+
+def _distributed_trainer(args, rank, dataset, context, eval_feed_dicts, samples, time_stamp, shared, barrier,
+                         queue):
+    global _rank
+    global _shared
+    global _barrier
+    try:
+        begin = time()
+        _rank, _shared, _barrier = rank, shared, barrier
+        # the trainers share the stream and the --workers
+        metrics.set_fields(rank=rank)
+        args.workers = max(1, args.workers // args.trainers)
+        if rank > 0:
+            # rank 0 prints, logs and profiles for all trainers
+            sys.stdout = open(os.devnull, 'w')
+            logging.disable(logging.INFO)
+            args.profile = 0
+        init_sampling(dataset, args, context)
+        partition_sampling(dataset, rank, args.trainers)
+        eval_feed_dicts = {u: feed for u, feed in eval_feed_dicts.items() if u % args.trainers == rank}
+
+        _import_tensorflow()
+        model = MF(dataset.num_users, dataset.num_items, args)
+        model.build_graph()
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            _broadcast_items(model, sess)
+
+            args.adver = 0
+            print("Initialize MPR")
+            best_res = training(model, sess, dataset, args, samples, eval_feed_dicts,
+                                epoch_start=0, epoch_end=_mpr_epoch_end(args), time_stamp=time_stamp)
+            args.adver = 1
+            print("Initialize AT-MPR")
+            best_res = training(model, sess, dataset, args, samples, eval_feed_dicts,
+                                epoch_start=best_res['stopped'] + 1, epoch_end=args.epochs, time_stamp=time_stamp)
+        queue.put({'rank': rank, 'best_res': best_res, 'seconds': time() - begin})
+    except Exception as e:
+        # the other trainers would wait for this one forever, the parent aborts the barrier
+        # as well when a trainer dies without getting here
+        barrier.abort()
+        queue.put({'rank': rank, 'error': repr(e)})
+        raise
+
+
+def distributed_training(args, time_stamp):
+    if args.restore is not None or args.update is not None:
+        raise ValueError("--trainers trains from scratch, it does not support --restore or --update")
+    dataset, context = load_dataset(args)
+
+    # built once and inherited by the forked trainers
+    with metrics.stage('eval_context'):
+        eval_feed_dicts = init_eval_model(None, dataset)
+    with metrics.stage('sampling_context'):
+        init_sampling(dataset, args, context)
+        context = get_sampling_context()
+
+    # the trainers run the same no. of batches per epoch, so that they meet at every synchronization
+    num_samples = len(sampling(dataset)[0]) // args.trainers
+    samples = range(num_samples), range(num_samples)
+
+    n, m, d = args.trainers, dataset.num_items, args.embed_size
+    shared = {'Q': _shared_array('f', n, m, d), 'Q_acc': _shared_array('f', n, m, d),
+              'Q_avg': _shared_array('f', m, d), 'Q_acc_avg': _shared_array('f', m, d),
+              'P': _shared_array('f', dataset.num_users, d), 'P_acc': _shared_array('f', dataset.num_users, d),
+              'eval': _shared_array('d', n, 3, 100), 'eval_count': _shared_array('d', n)}
+    barrier = Barrier(n)
+
+    targets = [(_distributed_trainer, (args, rank, dataset, context, eval_feed_dicts, samples, time_stamp,
+                                       shared, barrier)) for rank in range(n)]
+    with metrics.stage('distributed_training', trainers=n):
+        results = _run_processes(targets, n, on_failure=barrier.abort)
+
+    errors = ['rank %d: %s' % (res['rank'], res['error']) for res in results if 'error' in res]
+    reported = set(res['rank'] for res in results)
+    errors += ['rank %d: exited without a result' % rank for rank in range(n) if rank not in reported]
+    if errors:
+        raise RuntimeError("%d of %d trainers finished: %s" % (n - len(errors), n, '; '.join(errors)))
+    best_res = [res for res in results if res['rank'] == 0][0]['best_res']
+    if 'result' in best_res:
+        res = "Best AT-MPR epoch %d: HR = %.4f, NDCG = %.4f [%d trainers, %.1f s]" % \
+              (best_res['epoch'], best_res['result'][0][-1], best_res['result'][1][-1], n,
+               max(res['seconds'] for res in results))
+        logging.info(res)
+        print(res)
 
 
 def output_evaluate(model, sess, dataset, train_batches, eval_feed_dicts, epoch_count, batch_time, train_time, prev_acc,
@@ -367,7 +961,8 @@ def output_evaluate(model, sess, dataset, train_batches, eval_feed_dicts, epoch_
     loss_time = time() - loss_begin
 
     eval_begin = time()
-    result = evaluate(model, sess, dataset, eval_feed_dicts, output_adv)
+    with metrics.timer('evaluate'):
+        result = evaluate(model, sess, dataset, eval_feed_dicts, output_adv)
     eval_time = time() - eval_begin
 
     # check embedding
@@ -396,8 +991,18 @@ def training_batch(model, sess, batches, adver=False):
                          model.item_input_pos: item_input_pos[i],
                          model.item_input_neg: item_input_neg[i]}
             if adver:
-                sess.run([model.update_P, model.update_Q], feed_dict)
-            sess.run(model.optimizer, feed_dict)
+                refresh_delta(model, sess, user_input, item_input_pos, item_input_neg, i)
+                with metrics.timer('train_step'):
+                    if model.adv_accumulate:
+                        sess.run([model.optimizer_adv] + model.accumulate, feed_dict)
+                        model.accumulated = model.accumulated or i + 1 >= _refresh_window(model, len(user_input))
+                    else:
+                        sess.run(model.optimizer_adv, feed_dict)
+            else:
+                with metrics.timer('train_step'):
+                    sess.run(model.optimizer, feed_dict)
+            metrics.count('triplets', len(user_input[i]))
+            _sync_point(model, sess, i, len(user_input))
     # dns > 1, i.e., MPR-dns
     elif model.dns > 1:
         item_input_neg = []
@@ -416,11 +1021,35 @@ def training_batch(model, sess, batches, adver=False):
             feed_dict = {model.user_input: user_input[i],
                          model.item_input_pos: item_input_pos[i],
                          model.item_input_neg: item_neg_batch}
-            sess.run(model.optimizer, feed_dict)
+            with metrics.timer('train_step'):
+                sess.run(model.optimizer, feed_dict)
+            metrics.count('triplets', len(user_input[i]))
             item_input_neg.append(item_neg_batch)
+            _sync_point(model, sess, i, len(user_input))
     return user_input, item_input_pos, item_input_neg
 
 
+def _refresh_window(model, num_batch):
+    return model.adv_refresh if model.adv_refresh > 0 else num_batch
+
+
+# input: model, sess, the mini-batches of the epoch, index i of the next batch
+# do: update the adversarial noise when batch i starts an --adv_refresh window
+def refresh_delta(model, sess, user_input, item_input_pos, item_input_neg, i):
+    window = _refresh_window(model, len(user_input))
+    if i % window != 0:
+        return
+    with metrics.timer('adv_update'):
+        # the accumulated gradients of the previous window, or those of the coming window
+        # in a single pass, e.g. at the start of AT-MPR when nothing has been accumulated yet
+        if model.adv_accumulate and model.accumulated:
+            sess.run(model.refresh_delta)
+        else:
+            adv_update(model, sess, (user_input[i:i + window], item_input_pos[i:i + window],
+                                     item_input_neg[i:i + window]))
+    metrics.count('adv_refresh')
+
+
 # calculate the gradients
 # update the adversarial noise
 def adv_update(model, sess, train_batches):
@@ -460,18 +1089,23 @@ def init_eval_model(model, dataset):
     begin_time = time()
     global _dataset
     global _model
+    global _train_items
     _dataset = dataset
     _model = model
-    
-    # feed_dicts = []
-    # for user in range(_dataset.num_users):
-    #     temp = _evaluate_input(user)
-    #     feed_dicts.append(temp)
-        
-    pool = Pool(cpu_count())
-    feed_dicts = pool.map(_evaluate_input, range(_dataset.num_users))
-    pool.close()
-    pool.join()
+
+    # only the users with a testing item are evaluated
+    test_users = np.flatnonzero(_dataset.testItems >= 0)
+    if args.out_of_core:
+        # the shards are user-sorted already, the inputs are built per user at evaluation
+        _train_items = (_dataset.indptr, None)
+        feed_dicts = dict.fromkeys(test_users.tolist())
+    else:
+        # training items grouped by user in one pass: (offsets, items)
+        users = _dataset.trainList['user'].values
+        order = np.argsort(users, kind='stable')
+        _train_items = (np.searchsorted(users[order], np.arange(_dataset.num_users + 1)),
+                        _dataset.trainList['item'].values[order])
+        feed_dicts = dict(zip(test_users.tolist(), _pool_map(_evaluate_input, test_users)))
 
     print("Load the evaluation model done [%.1f s]" % (time() - begin_time))
     return feed_dicts
@@ -479,14 +1113,17 @@ def init_eval_model(model, dataset):
 
 def _evaluate_input(user):
     # generate items_list
-    test_item = _dataset.testRatings['item'][user]
-    item_input = set(range(_dataset.num_items)) - set(_dataset.trainList[_dataset.trainList['user'] == user]['item'])
-    if test_item in item_input:
-        item_input.remove(test_item)
-    item_input = list(item_input)
-    item_input.append(test_item)
+    test_item = _dataset.testItems[user]
+    offsets, train_items = _train_items
+    candidates = np.ones(_dataset.num_items, dtype=bool)
+    if train_items is None:
+        candidates[_dataset.user_items(user)] = False
+    else:
+        candidates[train_items[offsets[user]:offsets[user + 1]]] = False
+    candidates[test_item] = False
+    item_input = np.append(np.flatnonzero(candidates), test_item)
     user_input = np.full(len(item_input), user, dtype='int32')[:, None]
-    item_input = np.asarray(item_input)[:, None]
+    item_input = item_input[:, None]
     return user_input, item_input
 
 
@@ -505,9 +1142,17 @@ def evaluate(model, sess, dataset, feed_dicts, output_adv):
     _output = output_adv
 
     res = []
-    for user in range(_dataset.num_users):
+    for user in _feed_dicts:
         res.append(_eval_by_user(user))
     res = np.asarray(res)
+    if _barrier is not None:
+        # --trainers evaluate their own users, the means are taken over all of them
+        _shared['eval'][_rank] = res.sum(axis=0) if len(res) else 0
+        _shared['eval_count'][_rank] = len(res)
+        _barrier.wait()
+        hr, ndcg, auc = (_shared['eval'].sum(axis=0) / max(_shared['eval_count'].sum(), 1)).tolist()
+        _barrier.wait()
+        return hr, ndcg, auc
     hr, ndcg, auc = (res.mean(axis=0)).tolist()
 
     return hr, ndcg, auc
@@ -515,7 +1160,7 @@ def evaluate(model, sess, dataset, feed_dicts, output_adv):
 
 def _eval_by_user(user):
     # get prredictions of data in testing set
-    user_input, item_input = _feed_dicts[user]
+    user_input, item_input = _feed_dicts[user] if _feed_dicts[user] is not None else _evaluate_input(user)
     feed_dict = {_model.user_input: user_input, _model.item_input_pos: item_input}
     if _output:
         predictions = _sess.run(_model.output_adv, feed_dict)
@@ -545,31 +1190,419 @@ def init_logging(args, time_stamp):
     print(args)
 
 
+def _cache_path(args):
+    return args.path + args.dataset + '.cache.pkl'
+
+
+def _store_path(args):
+    return args.path + args.dataset + '.shards/'
+
+
+# input: args
+# output: the shard store of the dataset, ingested first when it is missing, outdated or older than the rating files
+def load_store(args):
+    from utility.shards import ShardedData, ingest_ratings, STORE_VERSION
+    meta_path = _store_path(args) + 'meta.json'
+    sources = [args.path + args.dataset + suffix for suffix in ['.train.rating', '.test.rating']]
+    version = None
+    if os.path.exists(meta_path) and \
+            all(os.path.getmtime(meta_path) >= os.path.getmtime(source) for source in sources):
+        with open(meta_path) as f:
+            version = json.load(f).get('version')
+    # stores of another layout are ingested again
+    if version != STORE_VERSION:
+        ingest_begin = time()
+        with metrics.stage('ingest'):
+            meta = ingest_ratings(args.path + args.dataset, _store_path(args), args.shard_users, args.chunk_rows)
+        print("Ingest %d ratings into %d shards of %s [%.1f s]" %
+              (meta['num_train'], meta['num_shards'], _store_path(args), time() - ingest_begin))
+    with metrics.stage('data_load', out_of_core=True):
+        return ShardedData(_store_path(args))
+
+
+# input: args
+# output: (dataset, sampling context), from the cache of `prepare` when it is newer than the rating files
+def load_dataset(args):
+    if args.out_of_core:
+        return load_store(args), None
+    cache_path = _cache_path(args)
+    sources = [args.path + args.dataset + suffix for suffix in ['.train.rating', '.test.rating']]
+    if os.path.exists(cache_path) and \
+            all(os.path.getmtime(cache_path) >= os.path.getmtime(source) for source in sources):
+        with metrics.stage('data_load', cache=True):
+            with open(cache_path, 'rb') as f:
+                cache = pickle.load(f)
+        print("Load the dataset cache %s" % cache_path)
+        # the sampling context depends on beta
+        if not hasattr(cache['dataset'], 'user_ids'):
+            raise ValueError("The dataset cache %s predates the dense ID index, rerun `prepare`" % cache_path)
+        return cache['dataset'], cache['context'] if cache['beta'] == args.beta else None
+
+    from utility.load_data import Data
+    with metrics.stage('data_load', cache=False):
+        dataset = Data(args.path + args.dataset)
+    return dataset, None
+
+
+def find_checkpoint(args, phases):
+    _import_tensorflow()
+    for phase in phases:
+        ckpt_restore_path = "../Pretrain/%s/%s/embed_%d/%s/" % (args.dataset, phase, args.embed_size, args.restore)
+        ckpt = tf.train.get_checkpoint_state(os.path.dirname(ckpt_restore_path + 'checkpoint'))
+        if ckpt and ckpt.model_checkpoint_path:
+            return ckpt.model_checkpoint_path
+    raise ValueError("No %s checkpoint found for --restore %s" % (' or '.join(phases), args.restore))
+
+
+# input: dataset, checkpoint path, cached sampling context
+# output: the sampling context, void when the dataset had to be re-indexed like the checkpoint
+def align_dataset(dataset, checkpoint_path, context=None):
+    id_map_path = os.path.join(os.path.dirname(checkpoint_path), 'id_map.npz')
+    if os.path.exists(id_map_path) and dataset.set_id_map(dataset.load_id_map(id_map_path)):
+        print("Re-index the dataset like %s" % id_map_path)
+        return None
+    return context
+
+
+def _checkpoint_data_path(checkpoint_path):
+    return os.path.join(os.path.dirname(checkpoint_path), 'data.pkl')
+
+
+# input: args, checkpoint path
+# output: (dataset, sampling context) of the checkpoint, as saved by --update with the ratings it folded in,
+#         else from the rating files re-indexed like the checkpoint
+def load_checkpoint_dataset(args, checkpoint_path):
+    data_path = _checkpoint_data_path(checkpoint_path)
+    if not os.path.exists(data_path):
+        dataset, context = load_dataset(args)
+        return dataset, align_dataset(dataset, checkpoint_path, context)
+    if args.out_of_core:
+        raise ValueError("%s holds ratings folded in by --update, they need the in-memory dataset" % data_path)
+    with metrics.stage('data_load', checkpoint=True):
+        with open(data_path, 'rb') as f:
+            state = pickle.load(f)
+    print("Load the dataset of %s" % data_path)
+    # the sampling context depends on beta
+    return state['dataset'], state['context'] if state['beta'] == args.beta else None
+
+
+# build a model sized by the checkpoint and restore its weights, the dataset follows its ID map
+# output: (model, sess, dataset, context)
+def restore_model(args, phases):
+    checkpoint_path = find_checkpoint(args, phases)
+    dataset, context = load_checkpoint_dataset(args, checkpoint_path)
+    shapes = dict(tf.train.list_variables(checkpoint_path))
+    model = MF(shapes['embedding_P'][0], shapes['embedding_Q'][0], args)
+    model.build_graph()
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    with metrics.stage('checkpoint_restore'):
+        restore_checkpoint(model, sess, checkpoint_path)
+    print("Restore %s" % checkpoint_path)
+    return model, sess, dataset, context
+
+
+def cmd_prepare(args, time_stamp):
+    if args.out_of_core:
+        load_store(args)
+        return
+
+    from utility.load_data import Data
+    with metrics.stage('data_load', cache=False):
+        dataset = Data(args.path + args.dataset)
+    with metrics.stage('sampling_context'):
+        init_sampling(dataset, args)
+
+    with open(_cache_path(args), 'wb') as f:
+        pickle.dump({'dataset': dataset, 'beta': args.beta, 'context': get_sampling_context()}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    print("Write the dataset cache %s" % _cache_path(args))
+
+
+def cmd_train(args, time_stamp):
+    if args.trainers > 1:
+        # forked before TensorFlow is imported
+        return distributed_training(args, time_stamp)
+    _import_tensorflow()
+
+    if args.update is not None:
+        if args.out_of_core:
+            raise ValueError("--update folds ratings into the in-memory dataset, it does not support --out_of_core")
+        # incremental mode: restore the latest weights with the dataset and sampling context of the
+        # earlier updates, fold in the new ratings, the tables are sized by the checkpoint,
+        # grow_model takes over from there
+        model, sess, dataset, context = restore_model(args, ['online', 'AT-MPR', 'MPR'])
+        with metrics.stage('sampling_context'):
+            init_sampling(dataset, args, context)
+        new_ratings, _, _ = dataset.load_ratings(args.update)
+        model, sess = online_training(model, sess, dataset, args, new_ratings, time_stamp)
+        sess.close()
+        return
+
+    dataset, context = load_dataset(args)
+
+    # the pretrained rows must keep their users and items
+    ckpt_restore_path = None
+    if args.restore is not None:
+        ckpt_restore_path = "../Pretrain/%s/MPR/embed_%d/%s/" % (args.dataset, args.embed_size, args.restore)
+        ckpt = tf.train.get_checkpoint_state(os.path.dirname(ckpt_restore_path + 'checkpoint'))
+        ckpt_restore_path = ckpt.model_checkpoint_path if ckpt and ckpt.model_checkpoint_path else None
+        if ckpt_restore_path is not None:
+            context = align_dataset(dataset, ckpt_restore_path, context)
+
+    # initialize a single model, the adversarial term is switched on by the train op
+    model = MF(dataset.num_users, dataset.num_items, args)
+    model.build_graph()
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+
+        # restore the weights when pretrained
+        if args.restore is not None:
+            if ckpt_restore_path is not None:
+                restore_checkpoint(model, sess, ckpt_restore_path)
+        # initialize the weights
+        else:
+            logging.info("Initialized from scratch")
+            print("Initialized from scratch")
+
+        # initialize for Evaluate
+        with metrics.stage('eval_context'):
+            eval_feed_dicts = init_eval_model(model, dataset)
+
+        # sample the data
+        samples = sampling(dataset)
+        with metrics.stage('sampling_context'):
+            init_sampling(dataset, args, context)
+
+        args.adver = 0
+        print("Initialize MPR")
+
+        # start training
+        best_res = training(model, sess, dataset, args, samples, eval_feed_dicts,
+                            epoch_start=0, epoch_end=_mpr_epoch_end(args), time_stamp=time_stamp)
+
+        args.adver = 1
+        print("Initialize AT-MPR")
+
+        # continue training in the same session, no reload from disk
+        training(model, sess, dataset, args, samples, eval_feed_dicts,
+                 epoch_start=best_res['stopped'] + 1, epoch_end=args.epochs, time_stamp=time_stamp)
+
+
+def cmd_evaluate(args, time_stamp):
+    _import_tensorflow()
+    # the dataset of an online checkpoint holds the items folded in by --update as training items
+    model, sess, dataset, _ = restore_model(args, [args.phase] if args.phase else ['online', 'AT-MPR', 'MPR'])
+
+    with metrics.stage('eval_context'):
+        eval_feed_dicts = init_eval_model(model, dataset)
+    with metrics.stage('evaluate'):
+        hr, ndcg, auc = evaluate(model, sess, dataset, eval_feed_dicts, 0)
+    sess.close()
+
+    k = min(args.topk, len(hr))
+    res = "HR@%d = %.4f, NDCG@%d = %.4f, AUC = %.4f" % (k, hr[k - 1], k, ndcg[k - 1], auc[k - 1])
+    logging.info(res)
+    print(res)
+
+
+def cmd_recommend(args, time_stamp):
+    _import_tensorflow()
+    # the dataset of an online checkpoint holds the items folded in by --update as training items
+    model, sess, dataset, _ = restore_model(args, [args.phase] if args.phase else ['online', 'AT-MPR', 'MPR'])
+    embedding_P, embedding_Q = sess.run([model.embedding_P, model.embedding_Q])
+    sess.close()
+
+    # --users and the output are raw IDs, the model only knows the rows it was trained with
+    num_users, num_items = min(dataset.num_users, model.num_users), min(dataset.num_items, model.num_items)
+    users = range(num_users)
+    if args.users:
+        unknown = [user for user in args.users if dataset.user_index.get(user, num_users) >= num_users]
+        if unknown:
+            print("Skip the unknown users %s" % ' '.join(str(user) for user in unknown))
+        users = [dataset.user_index[user] for user in args.users if user not in unknown]
+
+    # the trained items are not recommended again
+    train_csr = dataset.trainMatrix.tocsr() if not args.out_of_core else None
+    output = open(args.output, 'w') if args.output else sys.stdout
+    with metrics.stage('recommend', users=len(users)):
+        for user in users:
+            scores = embedding_Q[:num_items].dot(embedding_P[user])
+            if train_csr is None:
+                train_items = dataset.user_items(user)
+            else:
+                train_items = train_csr.indices[train_csr.indptr[user]:train_csr.indptr[user + 1]]
+            scores[train_items[train_items < num_items]] = -np.inf
+            topk = min(args.topk, len(scores))
+            top = np.argpartition(-scores, topk - 1)[:topk]
+            top = top[np.argsort(-scores[top])]
+            output.write("%d\t%s\n" % (dataset.user_ids[user], ','.join(str(item) for item in dataset.item_ids[top])))
+    if output is not sys.stdout:
+        output.close()
+
+
+# the MPR warm-start shared by all trials with the same (lr, beta, sampling)
+def _sweep_warm_start(args, group, dataset, context, eval_feed_dicts, snapshot_path, time_stamp, queue):
+    try:
+        for key, value in group.items():
+            setattr(args, key, value)
+        _import_tensorflow()
+        model = MF(dataset.num_users, dataset.num_items, args)
+        model.build_graph()
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            init_sampling(dataset, args, context)
+            args.adver = 0
+            best_res = training(model, sess, dataset, args, sampling(dataset), eval_feed_dicts,
+                                epoch_start=0, epoch_end=_mpr_epoch_end(args), time_stamp=time_stamp)
+            save_snapshot(model, sess, snapshot_path)
+        res = dict(group, snapshot=snapshot_path, adv_epoch=best_res['stopped'] + 1)
+        # the result of trials whose AT-MPR phase is never evaluated
+        if 'result' in best_res:
+            res.update(hr=best_res['result'][0][-1], ndcg=best_res['result'][1][-1], best_epoch=best_res['epoch'])
+        queue.put(res)
+    except Exception as e:
+        queue.put(dict(group, error=repr(e)))
+        raise
+
+
+# one AT-MPR trial, forked from the warm-start snapshot of its group
+def _sweep_trial(args, trial, dataset, context, eval_feed_dicts, warm_res, time_stamp, queue):
+    try:
+        begin = time()
+        for key, value in trial.items():
+            setattr(args, key, value)
+        _import_tensorflow()
+        model = MF(dataset.num_users, dataset.num_items, args)
+        model.build_graph()
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if 'snapshot' in warm_res:
+                load_snapshot(model, sess, warm_res['snapshot'])
+            init_sampling(dataset, args, context)
+            args.adver = 1
+            best_res = training(model, sess, dataset, args, sampling(dataset), eval_feed_dicts,
+                                epoch_start=args.adv_epoch, epoch_end=args.epochs, time_stamp=time_stamp)
+        if 'result' in best_res:
+            res = dict(hr=best_res['result'][0][-1], ndcg=best_res['result'][1][-1], best_epoch=best_res['epoch'],
+                       best_phase='AT-MPR')
+        elif 'ndcg' in warm_res:
+            # no AT-MPR evaluation, e.g. --adv_epoch >= --epochs or a warm-start that ran up to --epochs
+            res = dict(hr=warm_res['hr'], ndcg=warm_res['ndcg'], best_epoch=warm_res['best_epoch'], best_phase='MPR')
+        else:
+            res = dict(hr=np.nan, ndcg=np.nan, best_epoch=-1, best_phase='')
+        queue.put(dict(trial, seconds=time() - begin, **res))
+    except Exception as e:
+        queue.put(dict(trial, error=repr(e)))
+        raise
+
+
+# run the (target, args) jobs in forked processes, at most `jobs` at a time,
+# the processes inherit the loaded dataset instead of reloading it.
+# on_failure is called once when a process exits abnormally, e.g. killed by a signal,
+# the processes still running get a grace period to report and are terminated then
+def _run_processes(targets, jobs, on_failure=None):
+    queue = Queue()
+    pending, running, results = list(targets), [], []
+    while len(results) < len(targets):
+        if on_failure is not None and any(process.exitcode for process in running):
+            on_failure()
+            on_failure = None
+            for process in running:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+            pending = []
+        running = [process for process in running if process.is_alive()]
+        while pending and len(running) < jobs:
+            target, target_args = pending.pop(0)
+            process = Process(target=target, args=target_args + (queue,))
+            process.start()
+            running.append(process)
+        try:
+            results.append(queue.get(timeout=1))
+        except Empty:
+            if not pending and not any(process.is_alive() for process in running):
+                break
+    return results
+
+
+def cmd_sweep(args, time_stamp):
+    dataset, cached_context = load_dataset(args)
+    grid = {'lr': args.lr_grid or [args.lr], 'beta': args.beta_grid or [args.beta],
+            'neg_sampling_modes': args.sampling_grid or [args.neg_sampling_modes],
+            'eps': args.eps_grid or [args.eps], 'reg_adv': args.reg_adv_grid or [args.reg_adv]}
+
+    # read-only indexes shared by all trials
+    with metrics.stage('eval_context'):
+        eval_feed_dicts = init_eval_model(None, dataset)
+    contexts, cached_beta = {}, args.beta
+    for beta in grid['beta']:
+        with metrics.stage('sampling_context', beta=beta):
+            args.beta = beta
+            init_sampling(dataset, args, cached_context if beta == cached_beta else None)
+            contexts[beta] = get_sampling_context()
+
+    snapshot_dir = "../Pretrain/%s/sweep/embed_%d/%s/" % (args.dataset, args.embed_size, time_stamp)
+    if not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    groups = [{'lr': lr, 'beta': beta, 'neg_sampling_modes': mode}
+              for lr in grid['lr'] for beta in grid['beta'] for mode in grid['neg_sampling_modes']]
+    snapshots = {}
+    if _mpr_epoch_end(args) >= 0:
+        print("Sweep: %d MPR warm-starts" % len(groups))
+        targets = [(_sweep_warm_start, (args, group, dataset, contexts[group['beta']], eval_feed_dicts,
+                                        snapshot_dir + 'warm_%d.npz' % k, '%s_warm_%d' % (time_stamp, k)))
+                   for k, group in enumerate(groups)]
+        with metrics.stage('sweep_warm_start', groups=len(groups)):
+            for res in _run_processes(targets, args.jobs):
+                if 'snapshot' in res:
+                    snapshots[(res['lr'], res['beta'], res['neg_sampling_modes'])] = res
+
+    # the AT-MPR phase of a group starts where its warm-start stopped
+    trials = []
+    for group in groups:
+        key = (group['lr'], group['beta'], group['neg_sampling_modes'])
+        if _mpr_epoch_end(args) >= 0:
+            if key not in snapshots:
+                continue
+            group = dict(group, adv_epoch=snapshots[key]['adv_epoch'])
+        trials.extend(dict(group, eps=eps, reg_adv=reg_adv) for eps in grid['eps'] for reg_adv in grid['reg_adv'])
+    print("Sweep: %d AT-MPR trials" % len(trials))
+    targets = [(_sweep_trial, (args, trial, dataset, contexts[trial['beta']], eval_feed_dicts,
+                               snapshots.get((trial['lr'], trial['beta'], trial['neg_sampling_modes']), {}),
+                               '%s_trial_%d' % (time_stamp, k)))
+               for k, trial in enumerate(trials)]
+    with metrics.stage('sweep_trials', trials=len(trials)):
+        results = _run_processes(targets, args.jobs)
+
+    columns = ['lr', 'beta', 'neg_sampling_modes', 'adv_epoch', 'eps', 'reg_adv', 'hr', 'ndcg', 'best_epoch', 'best_phase',
+               'seconds', 'error']
+    table = args.table or "../Log/%s_sweep_%s.tsv" % (args.dataset, time_stamp)
+    with open(table, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for res in sorted(results, key=lambda res: -res.get('ndcg', -1)):
+            f.write('\t'.join(str(res.get(column, '')) for column in columns) + '\n')
+            print("lr=%s beta=%s sampling=%s eps=%s reg_adv=%s: HR = %.4f, NDCG = %.4f (%s epoch %s)" %
+                  (res['lr'], res['beta'], res['neg_sampling_modes'], res['eps'], res['reg_adv'],
+                   res.get('hr', np.nan), res.get('ndcg', np.nan), res.get('best_phase', ''), res.get('best_epoch', '-')))
+    print("Write the sweep table %s" % table)
+
+
 if __name__ == '__main__':
     # initilize arguments and logging
     args = parse_args()
     time_stamp = strftime('%Y_%m_%d_%H_%M_%S', localtime()) if args.restore is None else args.restore
     init_logging(args, time_stamp)
+    if args.metrics is not None:
+        metrics.init_metrics(args.metrics, args=vars(args), time_stamp=time_stamp)
+    args.profile_path = "../Log/%s_%s/%s_profile_%s.prof" % (strftime('%Y-%m-%d_%H', localtime()), args.task,
+                                                             args.dataset, time_stamp)
 
-    # initialize dataset
-    dataset = Data(args.path + args.dataset)
-    
-    args.adver = 0
-    # initialize MPR models
-    MPR = MF(dataset.num_users, dataset.num_items, args)
-    MPR.build_graph()
-
-    print("Initialize MPR")
-
-    # start training
-    training(MPR, dataset, args, epoch_start=0, epoch_end=args.adv_epoch-1, time_stamp=time_stamp)
-
-    args.adver = 1
-    # instialize AT_MPR model
-    AT_MPR = MF(dataset.num_users, dataset.num_items, args)
-    AT_MPR.build_graph()
-
-    print("Initialize AT-MPR")
+    {'prepare': cmd_prepare, 'train': cmd_train, 'evaluate': cmd_evaluate,
+     'recommend': cmd_recommend, 'sweep': cmd_sweep}[args.command](args, time_stamp)
 
-    # start training
-    training(AT_MPR, dataset, args, epoch_start=args.adv_epoch, epoch_end=args.epochs, time_stamp=time_stamp)
+    # fewer epochs than --profile were trained
+    metrics.stop_profile(args.profile_path)
@@ -0,0 +1,91 @@
+'''
+Cost and quality of the adversarial perturbation refresh schedules
+(--adv_refresh, --adv_accumulate). Every setting trains MPR then AT-MPR from
+scratch with a JSONL metrics stream, the AT-MPR epochs are compared by
+throughput, time spent refreshing the perturbation and best HR/NDCG.
+'''
+from __future__ import absolute_import
+from __future__ import division
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the adversarial perturbation refresh")
+    parser.add_argument('--path', nargs='?', default=os.path.join(ROOT, 'Data/'),
+                        help='Input data path.')
+    parser.add_argument('--dataset', nargs='?', default='CiaoDVD',
+                        help='Choose a dataset.')
+    parser.add_argument('--refresh', type=int, nargs='+', default=[1, 8, 64, 0],
+                        help='--adv_refresh values to compare, 1 is the per-batch baseline, 0 once per epoch.')
+    parser.add_argument('--accumulate', action='store_true',
+                        help='Also run every --refresh value above 1 and 0 with --adv_accumulate.')
+    parser.add_argument('--epochs', type=int, default=40,
+                        help='Number of epochs.')
+    parser.add_argument('--adv_epoch', type=int, default=20,
+                        help='Add AT-MPR in epoch X.')
+    parser.add_argument('--verbose', type=int, default=5,
+                        help='Evaluate per X epochs.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Batch processes per run.')
+    parser.add_argument('--batch_size', type=int, default=512,
+                        help='batch_size')
+    return parser.parse_args()
+
+
+def read_run(path):
+    """
+    Sums up the AT-MPR epochs of a run
+
+    Returns:
+        res (dict): `triplets_per_sec` of the train steps including the
+            refreshes, `adv_share` of the train time spent refreshing,
+            `refreshes` per epoch, best `hr` and `ndcg`, `epochs`
+    """
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    epochs = [record for record in records if record['event'] == 'epoch' and record['phase'] == 'AT-MPR']
+
+    train_time = sum(epoch['train_time'] for epoch in epochs)
+    adv_time = sum(epoch['timers'].get('adv_update', {}).get('seconds', 0.0) for epoch in epochs)
+    evaluated = [epoch for epoch in epochs if epoch['ndcg'] is not None]
+    best = max(evaluated, key=lambda epoch: epoch['ndcg']) if evaluated else {'hr': float('nan'),
+                                                                               'ndcg': float('nan')}
+    return {'triplets_per_sec': sum(epoch['counters'].get('triplets', 0) for epoch in epochs) / max(train_time, 1e-9),
+            'adv_share': adv_time / max(train_time, 1e-9),
+            'refreshes': sum(epoch['counters'].get('adv_refresh', 0) for epoch in epochs) / max(len(epochs), 1),
+            'hr': best['hr'], 'ndcg': best['ndcg'], 'epochs': len(epochs)}
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    settings = [(refresh, False) for refresh in args.refresh]
+    if args.accumulate:
+        settings += [(refresh, True) for refresh in args.refresh if refresh != 1]
+
+    runs = []
+    for refresh, accumulate in settings:
+        metrics_path = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'AT-MPR.py'), 'train',
+                               '--path', args.path, '--dataset', args.dataset, '--epochs', str(args.epochs),
+                               '--adv_epoch', str(args.adv_epoch), '--adv_refresh', str(refresh),
+                               '--verbose', str(args.verbose), '--workers', str(args.workers),
+                               '--batch_size', str(args.batch_size),
+                               '--ckpt', '0', '--metrics', metrics_path] +
+                              (['--adv_accumulate'] if accumulate else []), cwd=ROOT)
+        runs.append((refresh, accumulate, read_run(metrics_path)))
+
+    baseline = runs[0][2]['triplets_per_sec']
+    print("\n%d AT-MPR epochs per run, speedup against --adv_refresh %d" % (runs[0][2]['epochs'], runs[0][0]))
+    for refresh, accumulate, res in runs:
+        name = ('per epoch' if refresh == 0 else 'every %d' % refresh) + (' accumulated' if accumulate else '')
+        print("%-22s %10.0f triplets/s (x%.2f)  refresh %5.1f%% of train time, %6.1f per epoch  "
+              "best HR = %.4f, NDCG = %.4f" %
+              (name, res['triplets_per_sec'], res['triplets_per_sec'] / max(baseline, 1e-9),
+               100 * res['adv_share'], res['refreshes'], res['hr'], res['ndcg']))
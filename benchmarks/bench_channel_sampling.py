@@ -0,0 +1,83 @@
+'''
+Microbenchmark of the positive/negative channel samplers:
+np.random.choice per draw against the compiled alias tables.
+'''
+from __future__ import absolute_import
+from __future__ import division
+import os
+import sys
+import argparse
+import numpy as np
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utility.load_data import Data
+from utility.get_batch import get_channels, get_pos_neg_splits, get_overall_level_distributions, get_user_reps
+from utility.sampling import get_pos_channel, get_neg_channel, get_pos_channel_sampler, \
+    get_neg_channel_sampler, draw_pos_channels, draw_neg_channels
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the channel samplers")
+    parser.add_argument('--path', nargs='?', default='Data/',
+                        help='Input data path.')
+    parser.add_argument('--dataset', nargs='?', default='CiaoDVD',
+                        help='Choose a dataset.')
+    parser.add_argument('--draws', type=int, default=100000,
+                        help='Number of channels to draw per sampler.')
+    parser.add_argument('--beta', type=float, default=0.8,
+                        help='share of unobserved within negative feedback')
+    return parser.parse_args()
+
+
+def max_freq_error(draws, dist):
+    levels, counts = np.unique(draws, return_counts=True)
+    freq = dict(zip(levels.tolist(), (counts / len(draws)).tolist()))
+    return max(abs(freq.get(level, 0.0) - p) for level, p in dist.items())
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dataset = Data(args.path + args.dataset)
+
+    channels = get_channels(dataset.trainList)
+    train_inter_pos, train_inter_neg = get_pos_neg_splits(dataset.trainList)
+    pos_level_dist, _ = get_overall_level_distributions(train_inter_pos, train_inter_neg, args.beta)
+    user_reps = get_user_reps(dataset.num_users, 0, dataset.trainList, dataset.testRatings, channels, args.beta)
+
+    begin = time()
+    pos_sampler = get_pos_channel_sampler(pos_level_dist)
+    neg_sampler = get_neg_channel_sampler(user_reps, dataset.num_users)
+    print("compile alias tables: %.3fs (%d negative entries)" % (time() - begin, neg_sampler['end']))
+
+    users = np.random.randint(0, dataset.num_users, size=args.draws)
+
+    begin = time()
+    choice_pos = [get_pos_channel(pos_level_dist) for _ in range(args.draws)]
+    choice_pos_time = time() - begin
+    begin = time()
+    alias_pos = draw_pos_channels(pos_sampler, args.draws)
+    alias_pos_time = time() - begin
+
+    begin = time()
+    choice_neg = [get_neg_channel(user_reps[u]) for u in users]
+    choice_neg_time = time() - begin
+    begin = time()
+    alias_neg = draw_neg_channels(neg_sampler, users)
+    alias_neg_time = time() - begin
+
+    print("positive  np.random.choice: %.3fs [%.2f us/draw]  alias: %.3fs [%.3f us/draw]  speedup %.0fx" %
+          (choice_pos_time, 1e6 * choice_pos_time / args.draws, alias_pos_time,
+           1e6 * alias_pos_time / args.draws, choice_pos_time / max(alias_pos_time, 1e-9)))
+    print("negative  np.random.choice: %.3fs [%.2f us/draw]  alias: %.3fs [%.3f us/draw]  speedup %.0fx" %
+          (choice_neg_time, 1e6 * choice_neg_time / args.draws, alias_neg_time,
+           1e6 * alias_neg_time / args.draws, choice_neg_time / max(alias_neg_time, 1e-9)))
+    print("positive max |freq - p|: choice %.4f, alias %.4f" %
+          (max_freq_error(np.asarray(choice_pos), pos_level_dist), max_freq_error(alias_pos, pos_level_dist)))
+
+    # the negative channels of one user, drawn many times
+    user = max(range(dataset.num_users), key=lambda u: len(user_reps[u]['neg_channel_dist']))
+    user_draws = draw_neg_channels(neg_sampler, np.full(args.draws, user))
+    print("negative max |freq - p| of user %d: alias %.4f" %
+          (user, max_freq_error(user_draws, user_reps[user]['neg_channel_dist'])))
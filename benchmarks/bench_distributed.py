@@ -0,0 +1,96 @@
+'''
+Throughput of data-parallel training (--trainers) against a single process.
+Every configuration trains from scratch with a JSONL metrics stream, and the
+comparison is made at equal quality: the time each run needs to reach the
+lowest best NDCG of all runs.
+'''
+from __future__ import absolute_import
+from __future__ import division
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from time import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark data-parallel training")
+    parser.add_argument('--path', nargs='?', default=os.path.join(ROOT, 'Data/'),
+                        help='Input data path.')
+    parser.add_argument('--dataset', nargs='?', default='CiaoDVD',
+                        help='Choose a dataset.')
+    parser.add_argument('--trainers', type=int, nargs='+', default=[1, 2, 4],
+                        help='Trainer counts to compare, 1 is the single-process baseline.')
+    parser.add_argument('--epochs', type=int, default=40,
+                        help='Number of epochs.')
+    parser.add_argument('--adv_epoch', type=int, default=20,
+                        help='Add AT-MPR in epoch X.')
+    parser.add_argument('--sync_every', type=int, default=0,
+                        help='Average the item embeddings every X batches, 0 once per epoch.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Batch processes of a run, split between its trainers.')
+    parser.add_argument('--batch_size', type=int, default=512,
+                        help='batch_size')
+    return parser.parse_args()
+
+
+def read_run(path):
+    """
+    Aggregates the epoch records of all trainers of a run
+
+    Returns:
+        epochs (list): `(seconds since start, triplets/s, hr, ndcg)` per
+            (phase, epoch) in training order
+    """
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    start = min(record['time'] for record in records if record['event'] == 'run')
+
+    epochs = {}
+    for record in records:
+        if record['event'] != 'epoch':
+            continue
+        key = (record['phase'] == 'AT-MPR', record['epoch'])
+        epochs.setdefault(key, []).append(record)
+
+    res = []
+    for key in sorted(epochs):
+        ranks = epochs[key]
+        seconds = max(rank['batch_time'] + rank['train_time'] for rank in ranks)
+        triplets = sum(rank['counters'].get('triplets', 0) for rank in ranks)
+        # the evaluation is all-reduced, rank 0 reports it
+        first = [rank for rank in ranks if rank.get('rank', 0) == 0][0]
+        res.append((max(rank['time'] for rank in ranks) - start, triplets / max(seconds, 1e-9),
+                    first['hr'], first['ndcg']))
+    return res
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    runs = {}
+    for trainers in args.trainers:
+        metrics_path = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+        begin = time()
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'AT-MPR.py'), 'train',
+                               '--path', args.path, '--dataset', args.dataset, '--epochs', str(args.epochs),
+                               '--adv_epoch', str(args.adv_epoch), '--trainers', str(trainers),
+                               '--sync_every', str(args.sync_every), '--workers', str(args.workers),
+                               '--batch_size', str(args.batch_size), '--ckpt', '0', '--metrics', metrics_path],
+                              cwd=ROOT)
+        runs[trainers] = (read_run(metrics_path), time() - begin)
+
+    # equal quality: the lowest best NDCG that every run reached
+    target = min(max(epoch[3] for epoch in epochs if epoch[3] is not None) for epochs, _ in runs.values())
+    baseline = None
+    print("\ntarget NDCG@100 = %.4f" % target)
+    for trainers, (epochs, seconds) in sorted(runs.items()):
+        reached = [epoch[0] for epoch in epochs if epoch[3] is not None and epoch[3] >= target][0]
+        baseline = baseline or reached
+        best = max(epochs, key=lambda epoch: epoch[3] if epoch[3] is not None else -1)
+        print("trainers=%d  %10.0f triplets/s  best HR = %.4f, NDCG = %.4f  target after %7.1fs (x%.2f)  total %7.1fs" %
+              (trainers, sum(epoch[1] for epoch in epochs) / len(epochs), best[2], best[3], reached,
+               baseline / max(reached, 1e-9), seconds))
@@ -0,0 +1,67 @@
+'''
+Import-time budget of the AT-MPR.py entry point.
+Fails when `--help` or importing the module takes longer than the budget,
+or when importing it pulls in one of the heavy packages.
+'''
+from __future__ import absolute_import
+from __future__ import division
+import os
+import sys
+import argparse
+import subprocess
+from time import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEAVY = ['tensorflow', 'pandas', 'scipy']
+
+# imports AT-MPR.py the way benchmarks/run.py does and lists the heavy packages it loaded
+PROBE = '''
+import sys, importlib.util
+spec = importlib.util.spec_from_file_location('at_mpr', 'AT-MPR.py')
+module = importlib.util.module_from_spec(spec)
+sys.modules['at_mpr'] = module
+spec.loader.exec_module(module)
+print(' '.join(name for name in %r if name in sys.modules))
+''' % HEAVY
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check the import-time budget of AT-MPR.py")
+    parser.add_argument('--budget', type=float, default=1.0,
+                        help='Seconds allowed for `AT-MPR.py --help` and for importing the module.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per measurement, the fastest one counts.')
+    return parser.parse_args()
+
+
+def best_time(command):
+    best, output = None, ''
+    for _ in range(args.repeat):
+        begin = time()
+        output = subprocess.check_output(command, cwd=ROOT).decode()
+        elapsed = time() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    failures = []
+
+    help_time, _ = best_time([sys.executable, 'AT-MPR.py', '--help'])
+    print("AT-MPR.py --help  %.3fs (budget %.1fs)" % (help_time, args.budget))
+    if help_time > args.budget:
+        failures.append('--help took %.3fs' % help_time)
+
+    import_time, loaded = best_time([sys.executable, '-c', PROBE])
+    print("import AT-MPR.py  %.3fs (budget %.1fs), heavy packages loaded: %s" %
+          (import_time, args.budget, loaded.strip() or 'none'))
+    if import_time > args.budget:
+        failures.append('import took %.3fs' % import_time)
+    if loaded.strip():
+        failures.append('import loaded %s' % loaded.strip())
+
+    if failures:
+        print("FAILED: " + '; '.join(failures))
+        sys.exit(1)
+    print("OK")
@@ -0,0 +1,87 @@
+'''
+Peak resident memory of the in-memory dataset against the shard store of
+--out_of_core, from loading the ratings up to generating training batches.
+Every mode runs in its own process so that the peaks do not mix.
+'''
+from __future__ import absolute_import
+from __future__ import division
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+from time import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the memory of --out_of_core")
+    parser.add_argument('--path', nargs='?', default=None,
+                        help='Dataset path without the .train.rating suffix, a synthetic one by default.')
+    parser.add_argument('--users', type=int, default=200000,
+                        help='Users of the synthetic dataset.')
+    parser.add_argument('--items', type=int, default=50000,
+                        help='Items of the synthetic dataset.')
+    parser.add_argument('--density', type=float, default=0.001,
+                        help='Share of rated user-item pairs in the synthetic dataset.')
+    parser.add_argument('--shard_users', type=int, default=20000,
+                        help='Users per shard.')
+    parser.add_argument('--chunk_rows', type=int, default=1000000,
+                        help='Rows per ingest chunk.')
+    parser.add_argument('--num_batch', type=int, default=20,
+                        help='Training batches generated after loading.')
+    parser.add_argument('--mode', type=str, default=None,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def run_mode(args):
+    from run import load_at_mpr, peak_rss_mb
+
+    at_mpr = load_at_mpr()
+    argv = ['--workers', '1', '--shard_users', str(args.shard_users), '--chunk_rows', str(args.chunk_rows)]
+    at_mpr.args = at_mpr.parse_args(argv + (['--out_of_core'] if args.mode == 'shards' else []))
+
+    begin = time()
+    if args.mode == 'shards':
+        from utility.shards import ingest_ratings, ShardedData
+        store_dir = args.path + '.shards/'
+        ingest_ratings(args.path, store_dir, args.shard_users, args.chunk_rows)
+        dataset = ShardedData(store_dir)
+    else:
+        from utility.load_data import Data
+        dataset = Data(args.path)
+    at_mpr.init_sampling(dataset, at_mpr.args)
+    load_time = time() - begin
+
+    model = argparse.Namespace(dns=1)
+    begin = time()
+    at_mpr.shuffle(at_mpr.sampling(dataset), 512, dataset, model, num_batch=args.num_batch)
+    print("%-8s load + sampling context %8.1fs  %d batches %6.2fs  peak RSS %8.1f MB" %
+          (args.mode, load_time, args.num_batch, time() - begin, peak_rss_mb()))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.mode is not None:
+        run_mode(args)
+        sys.exit(0)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = args.path
+        if path is None:
+            from synthetic import make_dataset
+            path = os.path.join(tmp_dir, 'synthetic')
+            num_train = make_dataset(path, args.users, args.items, args.density)
+            print("synthetic: %d users, %d items, %d train ratings" % (args.users, args.items, num_train))
+        for mode in ['memory', 'shards']:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--path', path, '--mode', mode,
+                                   '--shard_users', str(args.shard_users), '--chunk_rows', str(args.chunk_rows),
+                                   '--num_batch', str(args.num_batch)])
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,225 @@
+'''
+Benchmark suite for the sampling, training-step and evaluation hot paths.
+Runs on the bundled datasets and on synthetic ones, writes one JSON file
+per run so that results can be compared between commits.
+'''
+from __future__ import absolute_import
+from __future__ import division
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import importlib.util
+from time import time
+from time import strftime
+from time import localtime
+from multiprocessing import cpu_count
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import make_dataset
+from utility.load_data import Data
+from utility.get_batch import get_channels, get_user_reps
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the AT-MPR hot paths")
+    parser.add_argument('--path', nargs='?', default=os.path.join(ROOT, 'Data/'),
+                        help='Input data path.')
+    parser.add_argument('--datasets', nargs='+', default=['CiaoDVD', 'synthetic'],
+                        help='Datasets in --path, `synthetic` generates one.')
+    parser.add_argument('--users', type=int, default=2000,
+                        help='Users of the synthetic dataset.')
+    parser.add_argument('--items', type=int, default=5000,
+                        help='Items of the synthetic dataset.')
+    parser.add_argument('--density', type=float, default=0.005,
+                        help='Share of rated user-item pairs in the synthetic dataset.')
+    parser.add_argument('--item_skew', type=float, default=1.0,
+                        help='Zipf exponent of the synthetic item popularity.')
+    parser.add_argument('--rating_skew', type=float, default=0.5,
+                        help='Skew of the synthetic ratings towards high values.')
+    parser.add_argument('--batch_size', type=int, default=512,
+                        help='batch_size')
+    parser.add_argument('--num_batch', type=int, default=50,
+                        help='Batches generated per sampling measurement.')
+    parser.add_argument('--embed_size', type=int, default=64,
+                        help='Embedding size.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, cpu_count()],
+                        help='Worker counts for the batch generation scaling.')
+    parser.add_argument('--skip_tf', action='store_true',
+                        help='Skip the stages that need TensorFlow.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON output, defaults to benchmarks/results/<commit>.json.')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='JSON of a previous run to compare the timings against.')
+    return parser.parse_args()
+
+
+def load_at_mpr():
+    # AT-MPR.py is not an importable module name, registered so that Pool can pickle its workers
+    spec = importlib.util.spec_from_file_location('at_mpr', os.path.join(ROOT, 'AT-MPR.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['at_mpr'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024.0
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def timed(results, name, func, triplets=None):
+    """
+    Runs `func` once and records its wall time and the peak RSS so far,
+    a stage that needs a missing package is recorded as skipped
+
+    Args:
+        results (dict): stage results, updated in place
+        name (str): stage name
+        func (callable): stage to time
+        triplets (int): (u, i, j) triplets produced or trained by the stage
+
+    Returns:
+        the return value of `func`, `None` when skipped
+    """
+    try:
+        begin = time()
+        value = func()
+        seconds = time() - begin
+    except ImportError as e:
+        results[name] = {'skipped': str(e)}
+        print("%-28s skipped (%s)" % (name, e))
+        return None
+
+    results[name] = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+    line = "%-28s %9.3fs  peak RSS %8.1f MB" % (name, seconds, results[name]['peak_rss_mb'])
+    if triplets is not None:
+        results[name]['triplets_per_sec'] = triplets / max(seconds, 1e-9)
+        line += "  %12.0f triplets/s" % results[name]['triplets_per_sec']
+    print(line)
+    return value
+
+
+def bench_dataset(prefix, name, args):
+    results = {}
+    dataset = timed(results, 'data_load', lambda: Data(prefix))
+    results['num_users'], results['num_items'] = int(dataset.num_users), int(dataset.num_items)
+    results['num_train'] = int(len(dataset.trainList))
+
+    channels = get_channels(dataset.trainList)
+    timed(results, 'get_user_reps', lambda: get_user_reps(dataset.num_users, 0, dataset.trainList,
+                                                          dataset.testRatings, channels, 0.8))
+
+    try:
+        at_mpr = load_at_mpr()
+    except ImportError as e:
+        results['AT-MPR'] = {'skipped': str(e)}
+        print("AT-MPR.py stages skipped (%s)" % e)
+        return results
+
+    at_mpr.args = at_mpr.parse_args(['--dataset', name, '--batch_size', str(args.batch_size),
+                                     '--embed_size', str(args.embed_size), '--workers', '1'])
+    model = at_mpr.MF(dataset.num_users, dataset.num_items, at_mpr.args)
+    timed(results, 'init_sampling', lambda: at_mpr.init_sampling(dataset, at_mpr.args))
+
+    triplets = args.num_batch * args.batch_size * model.dns
+    for mode in ['uniform', 'non-uniform']:
+        at_mpr.args.neg_sampling_modes = mode
+        timed(results, 'train_batch[%s]' % mode,
+              lambda: at_mpr.shuffle(([], []), args.batch_size, dataset, model, num_batch=args.num_batch),
+              triplets=triplets)
+
+    at_mpr.args.neg_sampling_modes = 'non-uniform'
+    for workers in sorted(set(args.workers)):
+        at_mpr.args.workers = workers
+        timed(results, 'shuffle[workers=%d]' % workers,
+              lambda: at_mpr.shuffle(([], []), args.batch_size, dataset, model, num_batch=args.num_batch),
+              triplets=triplets)
+
+    if args.skip_tf:
+        return results
+
+    def build():
+        tf = at_mpr._import_tensorflow()
+        tf.reset_default_graph()
+        model.build_graph()
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        return sess
+
+    sess = timed(results, 'build_graph', build)
+    if sess is None:
+        return results
+
+    at_mpr.args.workers = max(args.workers)
+    samples = at_mpr.sampling(dataset)
+    batches = at_mpr.shuffle(samples, args.batch_size, dataset, model)
+    epoch_triplets = len(batches[0]) * args.batch_size
+    timed(results, 'train_epoch[MPR]', lambda: at_mpr.training_batch(model, sess, batches, 0),
+          triplets=epoch_triplets)
+    timed(results, 'train_epoch[AT-MPR]', lambda: at_mpr.training_batch(model, sess, batches, 1),
+          triplets=epoch_triplets)
+
+    eval_feed_dicts = timed(results, 'init_eval_model', lambda: at_mpr.init_eval_model(model, dataset))
+    timed(results, 'evaluate', lambda: at_mpr.evaluate(model, sess, dataset, eval_feed_dicts, 0))
+    sess.close()
+
+    return results
+
+
+def compare(report, baseline):
+    print("\nCompared with %s (ratio < 1 is faster)" % baseline['commit'])
+    for name, stages in report['results'].items():
+        for stage, res in stages.items():
+            old = baseline['results'].get(name, {}).get(stage)
+            if isinstance(res, dict) and 'seconds' in res and isinstance(old, dict) and 'seconds' in old:
+                print("%-12s %-28s %9.3fs -> %9.3fs  x%.2f" %
+                      (name, stage, old['seconds'], res['seconds'], res['seconds'] / max(old['seconds'], 1e-9)))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = {'commit': git_commit(), 'created': strftime('%Y-%m-%d %H:%M:%S', localtime()),
+              'python': platform.python_version(), 'cpu_count': cpu_count(),
+              'config': vars(args), 'results': {}}
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name in args.datasets:
+            print("== %s" % name)
+            prefix = os.path.join(args.path, name)
+            if name == 'synthetic':
+                prefix = os.path.join(tmp_dir, name)
+                make_dataset(prefix, args.users, args.items, args.density, args.item_skew, args.rating_skew)
+            report['results'][name] = bench_dataset(prefix, name, args)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', '%s.json' % report['commit'])
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, default=float)
+    print("Results written to %s" % output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
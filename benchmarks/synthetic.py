@@ -0,0 +1,158 @@
+'''
+Synthetic multi-feedback datasets for the benchmarks and for scale testing.
+Users are generated in chunks and streamed to disk, so the output can be
+larger than memory, e.g.
+
+    python benchmarks/synthetic.py --out Data/synthetic --users 1000000 --items 500000
+'''
+from __future__ import absolute_import
+from __future__ import division
+import argparse
+import numpy as np
+from time import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a synthetic multi-feedback dataset")
+    parser.add_argument('--out', type=str, default='Data/synthetic',
+                        help='Output path without the .train.rating/.test.rating suffix.')
+    parser.add_argument('--users', type=int, default=100000,
+                        help='Number of users.')
+    parser.add_argument('--items', type=int, default=50000,
+                        help='Number of items.')
+    parser.add_argument('--density', type=float, default=0.0005,
+                        help='Share of rated user-item pairs, sets the mean user activity.')
+    parser.add_argument('--item_skew', type=float, default=1.0,
+                        help='Zipf exponent of the item popularity, 0 is uniform.')
+    parser.add_argument('--activity_exponent', type=float, default=2.0,
+                        help='Pareto exponent of the user activity, larger is less skewed.')
+    parser.add_argument('--rating_skew', type=float, default=0.5,
+                        help='Shift of the mean rating above 3.')
+    parser.add_argument('--chunk_users', type=int, default=10000,
+                        help='Users generated and written per chunk.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed.')
+    return parser.parse_args()
+
+
+def get_item_popularity(num_items, skew, rng):
+    """
+    Item sampling distribution, a Zipf law over randomly permuted item ranks
+
+    Args:
+        num_items (int): no. of unique items
+        skew (float): Zipf exponent, `0` means uniform popularity
+        rng (:obj:`np.random.RandomState`): random state
+
+    Returns:
+        cdf (:obj:`np.array`): (num_items, ) cumulative item probabilities
+    """
+    weights = 1.0 / np.arange(1, num_items + 1) ** skew
+    weights = weights[rng.permutation(num_items)]
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def get_user_activity(num_users, mean_activity, exponent, max_activity, rng):
+    """
+    Power-law (Pareto) no. of ratings per user with the given mean
+
+    Args:
+        num_users (int): no. of users in the chunk
+        mean_activity (float): expected no. of ratings per user
+        exponent (float): Pareto shape, must be larger than 1
+        max_activity (int): upper bound of the ratings per user
+        rng (:obj:`np.random.RandomState`): random state
+
+    Returns:
+        counts (:obj:`np.array`): (num_users, ) ratings per user, at least 2
+    """
+    scale = mean_activity * (exponent - 1) / exponent
+    counts = scale * (1 - rng.random_sample(num_users)) ** (-1.0 / exponent)
+    return np.clip(np.round(counts), 2, max_activity).astype(np.int64)
+
+
+def generate_chunk(first_user, num_users, num_items, item_cdf, item_quality, args, rng):
+    """
+    Generates the ratings of the users `first_user..first_user + num_users`
+
+    Ratings are `round(mean + user bias + item quality + noise)` clipped to
+    `1..5`, so every user has an own rating distribution around an own mean
+
+    Returns:
+        train (:obj:`np.array`): (r, 3) `[user, item, rating]` rows sorted by user
+        test (:obj:`np.array`): (num_users, 3) one held out row per user
+    """
+    counts = get_user_activity(num_users, args.density * num_items, args.activity_exponent,
+                               max(2, num_items // 2), rng)
+    users = np.repeat(np.arange(first_user, first_user + num_users), counts)
+    items = np.searchsorted(item_cdf, rng.random_sample(len(users)))
+
+    # drop repeated (user, item) pairs, top up users left with a single item
+    pairs = np.unique(users * num_items + items)
+    users, items = pairs // num_items, pairs % num_items
+    per_user = np.bincount(users - first_user, minlength=num_users)
+    short = np.where(per_user < 2)[0] + first_user
+    if len(short):
+        extra = np.repeat(short, 2) * num_items + rng.randint(0, num_items, size=2 * len(short))
+        pairs = np.unique(np.concatenate([pairs, extra]))
+        users, items = pairs // num_items, pairs % num_items
+
+    user_bias = rng.normal(0, 0.7, size=num_users)
+    ratings = 3.0 + args.rating_skew + user_bias[users - first_user] + item_quality[items] + \
+        rng.normal(0, 0.8, size=len(users))
+    ratings = np.clip(np.round(ratings), 1, 5).astype(np.int64)
+
+    # leave-one-out: a random rating of every user is held out
+    order = np.lexsort((rng.random_sample(len(users)), users))
+    rows = np.stack([users, items, ratings], axis=1)[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = rows[1:, 0] != rows[:-1, 0]
+
+    return rows[~first], rows[first]
+
+
+def make_dataset(prefix, num_users, num_items, density, item_skew=1.0, rating_skew=0.5,
+                 activity_exponent=2.0, chunk_users=10000, seed=0):
+    """
+    Writes `prefix.train.rating` and `prefix.test.rating` in the format of
+    `Data.load_ratings`, with one held out test rating for every user
+
+    Args:
+        prefix (str): output path without the `.train.rating` suffix
+        num_users (int): no. of users
+        num_items (int): no. of items
+        density (float): share of the user-item matrix that is rated
+        item_skew (float): Zipf exponent of the item popularity
+        rating_skew (float): shift of the mean rating above 3
+        activity_exponent (float): Pareto exponent of the user activity
+        chunk_users (int): users generated and written per chunk
+        seed (int): random seed
+
+    Returns:
+        num_train (int): no. of training instances written
+    """
+    args = argparse.Namespace(density=density, rating_skew=rating_skew, activity_exponent=activity_exponent)
+    rng = np.random.RandomState(seed)
+    item_cdf = get_item_popularity(num_items, item_skew, rng)
+    item_quality = rng.normal(0, 0.5, size=num_items)
+
+    num_train = 0
+    with open(prefix + ".train.rating", 'w') as train_file, open(prefix + ".test.rating", 'w') as test_file:
+        for first_user in range(0, num_users, chunk_users):
+            train, test = generate_chunk(first_user, min(chunk_users, num_users - first_user), num_items,
+                                         item_cdf, item_quality, args, rng)
+            np.savetxt(train_file, train, fmt='%d, %d, %d')
+            np.savetxt(test_file, test, fmt='%d, %d, %d')
+            num_train += len(train)
+
+    return num_train
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    begin = time()
+    num_train = make_dataset(args.out, args.users, args.items, args.density, args.item_skew, args.rating_skew,
+                             args.activity_exponent, args.chunk_users, args.seed)
+    print("Wrote %d train and %d test ratings to %s.{train,test}.rating [%.1f s]" %
+          (num_train, args.users, args.out, time() - begin))
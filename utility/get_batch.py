@@ -3,6 +3,7 @@ Created on July 18, 2019
 Utils. 
 @author: Zhang Pengbo (zhang26162@gmail.com)
 '''
+import logging
 import numpy as np
 from collections import OrderedDict 
 
@@ -161,6 +162,65 @@ def get_pos_channel_item_dict(train_inter_pos):
 
     return train_inter_pos_dict
 
+def get_user_rep(d, items, ratings, test_items, channels, beta):
+    """
+    Creates the representation of a single user from the user's own
+    (item, rating) interactions
+
+    Args:
+        d (int): no. of latent features for user and item representations,
+            0 leaves the latent features out
+        items (:obj:`np.array`): training items rated by the user
+        ratings (:obj:`np.array`): ratings aligned with `items`
+        test_items ([int]): testing items of the user
+        channels ([int]): rating values representing distinct feedback channels
+        beta (float): share of unobserved feedback within the overall
+            negative feedback
+
+    Returns:
+        user_rep (dict): user representation
+    """
+    items = np.asarray(items)
+    ratings = np.asarray(ratings)
+
+    user_rep = {}
+    if d > 0:
+        user_rep['embed'] = np.random.normal(size=(d,))
+    user_rep['mean_rating'] = ratings.mean() if len(ratings) else np.nan
+    user_rep['items'] = list(items)
+    user_rep['all_items'] = list(set(user_rep['items']).union(set(test_items)))
+    user_rep['pos_channel_items'] = OrderedDict()
+    user_rep['neg_channel_items'] = OrderedDict()
+    for channel in channels:
+        if channel >= user_rep['mean_rating']:
+            user_rep['pos_channel_items'][channel] = list(items[ratings == channel])
+        else:
+            user_rep['neg_channel_items'][channel] = list(items[ratings == channel])
+
+    pos_channels = np.array(list(user_rep['pos_channel_items'].keys()))
+    neg_channels = np.array(list(user_rep['neg_channel_items'].keys()))
+    pos_channel_counts = [len(user_rep['pos_channel_items'][key]) for key in pos_channels]
+    neg_channel_counts = [len(user_rep['neg_channel_items'][key]) for key in neg_channels]
+
+    user_rep['pos_channel_dist'] = \
+        get_pos_level_dist(pos_channels, pos_channel_counts, 'non-uniform')
+
+    if sum(neg_channel_counts) != 0:
+        user_rep['neg_channel_dist'] = \
+            get_neg_level_dist(neg_channels, neg_channel_counts, 'non-uniform')
+
+        # correct for beta
+        for key in user_rep['neg_channel_dist'].keys():
+            user_rep['neg_channel_dist'][key] = \
+                user_rep['neg_channel_dist'][key] * (1 - beta)
+        user_rep['neg_channel_dist'][-1] = beta
+
+    else:
+        # if there is no negative feedback, only unobserved remains
+        user_rep['neg_channel_dist'] = {-1: 1.0}
+
+    return user_rep
+
 def get_user_reps(m, d, train_inter, test_inter, channels, beta):
     """
     Creates user representations that encompass user latent features
@@ -169,7 +229,8 @@ def get_user_reps(m, d, train_inter, test_inter, channels, beta):
 
     Args:
         m (int): no. of unique users in the dataset
-        d (int): no. of latent features for user and item representations
+        d (int): no. of latent features for user and item representations,
+            0 leaves the latent features out
         train_inter (:obj:`pd.DataFrame`): `M` training instances (rows)
             with three columns `[user, item, rating]`
         test_ratings (:obj:`pd.DataFrame`): `M` testing instances (rows)
@@ -184,44 +245,128 @@ def get_user_reps(m, d, train_inter, test_inter, channels, beta):
     user_reps = {}
     train_inter = train_inter.sort_values('user')
 
-    for user_id in range(m):
-        user_reps[user_id] = {}
-        user_reps[user_id]['embed'] = np.random.normal(size=(d,))
-        user_item_ratings = train_inter[train_inter['user'] == user_id][['item', 'rating']]
-        user_reps[user_id]['mean_rating'] = user_item_ratings['rating'].mean()
-        user_reps[user_id]['items'] = list(user_item_ratings['item'])
-        user_reps[user_id]['all_items'] = list(set(user_reps[user_id]['items']).union(
-                                               set(list(test_inter[test_inter['user'] == user_id]['item']))))
-        user_reps[user_id]['pos_channel_items'] = OrderedDict()
-        user_reps[user_id]['neg_channel_items'] = OrderedDict()
-        for channel in channels:
-            if channel >= user_reps[user_id]['mean_rating']:
-                user_reps[user_id]['pos_channel_items'][channel] = \
-                    list(user_item_ratings[user_item_ratings['rating'] == channel]['item'])
-            else:
-                user_reps[user_id]['neg_channel_items'][channel] = \
-                    list(user_item_ratings[user_item_ratings['rating'] == channel]['item'])
-
-        pos_channels = np.array(list(user_reps[user_id]['pos_channel_items'].keys()))
-        neg_channels = np.array(list(user_reps[user_id]['neg_channel_items'].keys()))
-        pos_channel_counts = [len(user_reps[user_id]['pos_channel_items'][key]) for key in pos_channels]
-        neg_channel_counts = [len(user_reps[user_id]['neg_channel_items'][key]) for key in neg_channels]
-
-        user_reps[user_id]['pos_channel_dist'] = \
-            get_pos_level_dist(pos_channels, pos_channel_counts, 'non-uniform')
-
-        if sum(neg_channel_counts) != 0:
-            user_reps[user_id]['neg_channel_dist'] = \
-                get_neg_level_dist(neg_channels, neg_channel_counts, 'non-uniform')
-
-            # correct for beta
-            for key in user_reps[user_id]['neg_channel_dist'].keys():
-                user_reps[user_id]['neg_channel_dist'][key] = \
-                    user_reps[user_id]['neg_channel_dist'][key] * (1 - beta)
-            user_reps[user_id]['neg_channel_dist'][-1] = beta
+    # group once instead of filtering the whole frame for every user
+    train_groups = {user_id: group for user_id, group in train_inter.groupby('user')}
+    test_groups = {user_id: list(group) for user_id, group in test_inter.groupby('user')['item']}
+    empty = np.array([], dtype=np.int64)
 
+    for user_id in range(m):
+        if user_id in train_groups:
+            items = train_groups[user_id]['item'].values
+            ratings = train_groups[user_id]['rating'].values
         else:
-            # if there is no negative feedback, only unobserved remains
-            user_reps[user_id]['neg_channel_dist'] = {-1: 1.0}
+            items, ratings = empty, empty
+        user_reps[user_id] = get_user_rep(d, items, ratings, test_groups.get(user_id, []),
+                                          channels, beta)
+
+    return user_reps
+
+def update_user_reps(user_reps, new_inter, d, channels, beta):
+    """
+    Folds new (user, item, rating) interactions into the existing user
+    representations. Only the users in `new_inter` are rebuilt, from their
+    own channel buckets, so the cost is proportional to the delta.
+    A new rating for an already rated item replaces the old one
 
-    return user_reps
\ No newline at end of file
+    Args:
+        user_reps (dict): representations to update in place
+        new_inter (:obj:`pd.DataFrame`): new instances (rows)
+            with three columns `[user, item, rating]`
+        d (int): no. of latent features for user and item representations,
+            0 leaves the latent features out
+        channels ([int]): rating values representing distinct feedback channels
+        beta (float): share of unobserved feedback within the overall
+            negative feedback
+
+    Returns:
+        old_reps (dict): previous representations of the updated users,
+            `None` for users that were not known before
+    """
+    old_reps = {}
+    for user_id, group in new_inter.groupby('user'):
+        user_id = int(user_id)
+        old_rep = user_reps.get(user_id)
+        item_ratings = OrderedDict()
+        test_items = []
+        if old_rep is not None:
+            for channel_items in (old_rep['pos_channel_items'], old_rep['neg_channel_items']):
+                for channel, items in channel_items.items():
+                    for item in items:
+                        item_ratings[item] = channel
+            test_items = list(set(old_rep['all_items']) - set(old_rep['items']))
+        for item, rating in zip(group['item'].values, group['rating'].values):
+            item_ratings[item] = rating
+
+        user_rep = get_user_rep(d, list(item_ratings.keys()), list(item_ratings.values()),
+                                test_items, channels, beta)
+        if old_rep is not None and 'embed' in old_rep:
+            user_rep['embed'] = old_rep['embed']
+        user_reps[user_id] = user_rep
+        old_reps[user_id] = old_rep
+
+    return old_reps
+
+def get_pos_channel_item_index(train_inter_pos_dict):
+    """
+    Indexes the position of every (user, item) tuple within its positive
+    feedback channel bucket, so that tuples can be removed in O(1)
+
+    Args:
+        train_inter_pos_dict (dict): collection of all (user, item) interaction
+            tuples for each positive feedback channel
+
+    Returns:
+        pos_index (dict): `{channel: {(user, item): [positions]}}`, a tuple
+            has several positions when the training data repeats a rating
+    """
+    pos_index = {}
+    for key, u_i_tuples in train_inter_pos_dict.items():
+        positions = pos_index[key] = {}
+        for pos, u_i in enumerate(u_i_tuples):
+            positions.setdefault(u_i, []).append(pos)
+
+    return pos_index
+
+def update_pos_channel_item_dict(train_inter_pos_dict, pos_index, user_id, old_rep, new_rep):
+    """
+    Moves the positive (user, item) tuples of a single user between the
+    positive feedback channel buckets after the user representation changed
+
+    Args:
+        train_inter_pos_dict (dict): collection of all (user, item) interaction
+            tuples for each positive feedback channel, updated in place
+        pos_index (dict): positions from `get_pos_channel_item_index`,
+            updated in place
+        user_id (int): user ID
+        old_rep (dict): previous user representation or `None`
+        new_rep (dict): updated user representation
+    """
+    if old_rep is not None:
+        for channel, items in old_rep['pos_channel_items'].items():
+            bucket, positions = train_inter_pos_dict[channel], pos_index[channel]
+            for item in items:
+                # swap with the last tuple and pop
+                u_i_positions = positions[(user_id, item)]
+                pos = u_i_positions.pop()
+                if not u_i_positions:
+                    del positions[(user_id, item)]
+                last = bucket.pop()
+                if pos < len(bucket):
+                    bucket[pos] = last
+                    last_positions = positions[last]
+                    last_positions[last_positions.index(len(bucket))] = pos
+
+    for channel, items in new_rep['pos_channel_items'].items():
+        if not items:
+            continue
+        if channel not in train_inter_pos_dict:
+            train_inter_pos_dict[channel] = []
+            pos_index[channel] = {}
+        bucket, positions = train_inter_pos_dict[channel], pos_index[channel]
+        for item in items:
+            positions.setdefault((user_id, item), []).append(len(bucket))
+            bucket.append((user_id, item))
+
+    # keep the buckets ordered as in `get_pos_channel_item_dict`
+    for key in sorted(train_inter_pos_dict.keys(), reverse=True):
+        train_inter_pos_dict.move_to_end(key)
@@ -1,6 +1,6 @@
 '''
 Created on July 18, 2019
-Processing datasets. 
+Processing datasets.
 @author: Zhang Pengbo (zhang26162@gmail.com)
 '''
 import numpy as np
@@ -10,12 +10,12 @@ import scipy.sparse as sp
 
 
 class Data(object):
-    def __init__(self, path):
-        self.trainList,  self.num_users, self.num_items = self.load_ratings(path + ".train.rating")
-        self.testRatings, _, _ = self.load_ratings(path + ".test.rating")
-        
-        self.trainMatrix = self.get_trainMatrix()
-        
+    def __init__(self, path, id_map=None):
+        train_ratings, _, _ = self.load_ratings(path + ".train.rating")
+        test_ratings, _, _ = self.load_ratings(path + ".test.rating")
+
+        self.index_ratings(train_ratings, test_ratings, id_map)
+
     def load_ratings(self, filename):
         """
         loads the dataset, ignoring temporal information
@@ -25,24 +25,194 @@ class Data(object):
 
         Returns:
             ratings (:obj:`pd.DataFrame`): overall interaction instances (rows)
-                with three columns `[user, item, rating]`
+                with three columns `[user, item, rating]` holding raw IDs
             m (int): no. of unique users in the dataset
             n (int): no. of unique items in the dataset
         """
-        ratings = pd.read_csv(filename, sep=', ', names=['user', 'item', 'rating'])
-        
-        m = max(ratings['user']); m += 1
-        n = max(ratings['item']); n += 1
-        
+        ratings = pd.read_csv(filename, sep=',', skipinitialspace=True, names=['user', 'item', 'rating'])
+
+        m = ratings['user'].nunique()
+        n = ratings['item'].nunique()
+
         return ratings, m, n
-        
-        
+
+    def index_ratings(self, train_ratings, test_ratings, id_map=None):
+        """
+        builds the raw ID <-> dense index mapping and the dense training
+        and testing data, so that every table is sized by the no. of
+        distinct users and items rather than by the largest raw ID
+
+        Args:
+            train_ratings (:obj:`pd.DataFrame`): training instances with raw IDs
+            test_ratings (:obj:`pd.DataFrame`): testing instances with raw IDs
+            id_map ((:obj:`np.array`, :obj:`np.array`)): raw user and item IDs
+                that keep their dense index, e.g. from a checkpoint, unknown
+                IDs follow in sorted order
+        """
+        known_users, known_items = id_map if id_map is not None else ([], [])
+        self.user_ids = self.get_ids(known_users, [train_ratings['user'], test_ratings['user']])
+        self.item_ids = self.get_ids(known_items, [train_ratings['item'], test_ratings['item']])
+        self.user_index = dict(zip(self.user_ids.tolist(), range(len(self.user_ids))))
+        self.item_index = dict(zip(self.item_ids.tolist(), range(len(self.item_ids))))
+        self.num_users, self.num_items = len(self.user_ids), len(self.item_ids)
+
+        self.trainList = self.to_dense(train_ratings)
+        self.pair_rows = None
+        self.testRatings = self.to_dense(test_ratings)
+        self.testItems = self.get_testItems()
+        self.trainMatrix = self.get_trainMatrix()
+
+    def get_ids(self, known_ids, columns):
+        """
+        Returns:
+            ids (:obj:`np.array`): raw IDs by dense index, `known_ids` first
+        """
+        known_ids = np.asarray(known_ids, dtype=np.int64)
+        ids = np.unique(np.concatenate([column.values for column in columns]))
+        return np.concatenate([known_ids, np.setdiff1d(ids, known_ids)]).astype(np.int64)
+
+    def to_dense(self, ratings):
+        return ratings.assign(user=ratings['user'].map(self.user_index).values,
+                              item=ratings['item'].map(self.item_index).values)
+
+    def to_raw(self, ratings):
+        return ratings.assign(user=self.user_ids[ratings['user'].values],
+                              item=self.item_ids[ratings['item'].values])
+
+    def save_id_map(self, filename):
+        np.savez(filename, user_ids=self.user_ids, item_ids=self.item_ids)
+
+    @staticmethod
+    def load_id_map(filename):
+        id_map = np.load(filename)
+        return id_map['user_ids'], id_map['item_ids']
+
+    def set_id_map(self, id_map):
+        """
+        re-indexes the dataset so that the raw IDs of `id_map` get the
+        dense indices they had when `id_map` was saved, a no-op when the
+        indices already agree
+
+        Args:
+            id_map ((:obj:`np.array`, :obj:`np.array`)): raw user and item IDs
+
+        Returns:
+            reindexed (bool): whether the dense indices changed
+        """
+        known_users, known_items = id_map
+        if np.array_equal(self.user_ids[:len(known_users)], known_users) and \
+                np.array_equal(self.item_ids[:len(known_items)], known_items):
+            return False
+        self.index_ratings(self.to_raw(self.trainList), self.to_raw(self.testRatings), id_map)
+        return True
+
+    @property
+    def trainList(self):
+        # the chunks appended by append_ratings are merged on the first read
+        if len(self._train_chunks) > 1 or self._stale_rows:
+            self.compact_ratings()
+        return self._train_chunks[0]
+
+    @trainList.setter
+    def trainList(self, ratings):
+        self._train_chunks, self._stale_rows = [ratings], []
+        self._next_row = int(ratings.index.max()) + 1 if len(ratings) else 0
+
+    def __setstate__(self, state):
+        # caches pickled before the chunked training ratings hold a single frame
+        train_ratings = state.pop('trainList', None)
+        state.setdefault('pair_rows', None)
+        self.__dict__.update(state)
+        if train_ratings is not None:
+            self.trainList = train_ratings
+
+    def compact_ratings(self):
+        """
+        merges the appended chunks of the training instances into one
+        frame and drops the rows replaced since the last compaction
+        """
+        ratings = pd.concat(self._train_chunks) if len(self._train_chunks) > 1 else self._train_chunks[0]
+        if self._stale_rows:
+            ratings = ratings.drop(self._stale_rows)
+        self._train_chunks, self._stale_rows = [ratings], []
+
+    def get_pair_rows(self):
+        """
+        Returns:
+            pair_rows (dict): row labels of the training instances by dense
+                `(user, item)` pair, built once and kept (and pickled) with
+                the dataset
+        """
+        if self.pair_rows is None:
+            self.pair_rows = {}
+            train_ratings = self.trainList
+            for row, pair in zip(train_ratings.index, zip(train_ratings['user'].values.tolist(),
+                                                          train_ratings['item'].values.tolist())):
+                self.pair_rows.setdefault(pair, []).append(row)
+        return self.pair_rows
+
+    def append_ratings(self, ratings):
+        """
+        folds new training interactions into the dataset, a new rating
+        for an already rated (user, item) pair replaces the old rows of
+        that pair, rows of other pairs stay as loaded (also repeated ones),
+        new raw IDs get the next dense indices. The instances are appended
+        as a chunk and the replaced rows are only marked stale, the cost is
+        proportional to `ratings` until `trainList` is read
+
+        Args:
+            ratings (:obj:`pd.DataFrame`): new interaction instances (rows)
+                with three columns `[user, item, rating]` holding raw IDs
+
+        Returns:
+            ratings (:obj:`pd.DataFrame`): the new instances with dense indices
+        """
+        new_users = [user for user in pd.unique(ratings['user']) if user not in self.user_index]
+        new_items = [item for item in pd.unique(ratings['item']) if item not in self.item_index]
+        if new_users:
+            self.user_index.update(zip(new_users, range(self.num_users, self.num_users + len(new_users))))
+            self.user_ids = np.concatenate([self.user_ids, np.asarray(new_users, dtype=np.int64)])
+            self.testItems = np.concatenate([self.testItems, np.full(len(new_users), -1, dtype=np.int64)])
+        if new_items:
+            self.item_index.update(zip(new_items, range(self.num_items, self.num_items + len(new_items))))
+            self.item_ids = np.concatenate([self.item_ids, np.asarray(new_items, dtype=np.int64)])
+        self.num_users, self.num_items = len(self.user_ids), len(self.item_ids)
+
+        ratings = self.to_dense(ratings).drop_duplicates(['user', 'item'], keep='last')
+        ratings.index = pd.RangeIndex(self._next_row, self._next_row + len(ratings))
+        self._next_row += len(ratings)
+
+        pair_rows = self.get_pair_rows()
+        for row, pair in zip(ratings.index, zip(ratings['user'].values.tolist(), ratings['item'].values.tolist())):
+            self._stale_rows.extend(pair_rows.get(pair, []))
+            pair_rows[pair] = [row]
+        self._train_chunks.append(ratings)
+        # merged once the replaced rows make up half of the row labels, amortized O(1) per rating
+        if len(self._stale_rows) > self._next_row // 2:
+            self.compact_ratings()
+
+        self.trainMatrix.resize((self.num_users, self.num_items))
+        for user, item, rating in ratings[['user', 'item', 'rating']].values:
+            # assigning 0 drops the entry from the dok matrix
+            self.trainMatrix[int(user), int(item)] = 1.0 if rating > 0 else 0.0
+
+        return ratings
+
+    def get_testItems(self):
+        """
+        Returns:
+            test_items (:obj:`np.array`): (num_users, ) test item of every
+                dense user, `-1` for users without a test rating
+        """
+        test_items = np.full(self.num_users, -1, dtype=np.int64)
+        test_items[self.testRatings['user'].values] = self.testRatings['item'].values
+        return test_items
+
     def get_trainMatrix(self):
-        mat = sp.dok_matrix((self.num_users, self.num_items), dtype=np.float32)
-        
-        for i in range(len(self.trainList)):
-            user, item, rating = int(self.trainList['user'][i]), int(self.trainList['item'][i]),\
-                                 float(self.trainList['rating'][i]) 
-            if (rating > 0):
-                mat[user, item] = 1.0
-        return mat
+        positive = self.trainList[self.trainList['rating'] > 0]
+        mat = sp.coo_matrix((np.ones(len(positive), dtype=np.float32),
+                             (positive['user'].values, positive['item'].values)),
+                            shape=(self.num_users, self.num_items)).tocsr()
+        # repeated ratings are summed up by the conversion
+        mat.data[:] = 1.0
+        return mat.todok()
@@ -0,0 +1,195 @@
+'''
+Hot-path instrumentation.
+Timers, counters and stage records written to a JSONL stream per run.
+Everything is a no-op until `init_metrics` is called, so the calls can
+stay in the training loop.
+'''
+import os
+import sys
+import json
+import pstats
+import cProfile
+import resource
+from time import time
+
+_stream = None
+_timers = {}
+_counters = {}
+_fields = {}
+_profiler = None
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Timer(object):
+    def __init__(self, name, emit_fields=None):
+        self.name = name
+        self.emit_fields = emit_fields
+
+    def __enter__(self):
+        self.begin = time()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time() - self.begin
+        if self.emit_fields is not None:
+            emit('stage', name=self.name, seconds=seconds, **self.emit_fields)
+        else:
+            total = _timers.get(self.name)
+            if total is None:
+                _timers[self.name] = [1, seconds]
+            else:
+                total[0] += 1
+                total[1] += seconds
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def init_metrics(path, **run_info):
+    """
+    Opens the JSONL metrics stream of a run and writes the run record
+
+    Args:
+        path (str): JSONL file, appended to
+        run_info: fields of the run record, e.g. the arguments
+    """
+    global _stream
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    _stream = open(path, 'a')
+    emit('run', pid=os.getpid(), argv=sys.argv, **run_info)
+
+
+def set_fields(**fields):
+    """
+    Adds fields to every later record of this process, e.g. the rank of
+    a trainer that shares the stream with other processes
+
+    Args:
+        fields: JSON serializable values
+    """
+    _fields.update(fields)
+
+
+def enabled():
+    return _stream is not None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux, the pool workers are children
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024.0
+
+
+def emit(event, **fields):
+    """
+    Writes one record to the metrics stream
+
+    Args:
+        event (str): record type, e.g. `run`, `stage` or `epoch`
+        fields: JSON serializable values of the record
+    """
+    if _stream is None:
+        return
+    record = {'event': event, 'time': time(), 'peak_rss_mb': peak_rss_mb()}
+    record.update(_fields)
+    record.update(fields)
+    _stream.write(json.dumps(record, default=float) + '\n')
+    _stream.flush()
+
+
+def stage(name, **fields):
+    """
+    Times a one-off stage (dataset load, evaluation, ...) and writes
+    a `stage` record when it ends
+
+    Args:
+        name (str): stage name
+        fields: extra values of the record
+    """
+    if _stream is None:
+        return _NULL_TIMER
+    return _Timer(name, fields)
+
+
+def timer(name):
+    """
+    Times a hot-path call (batch generation, train step, ...), the
+    calls are summed up until the next `flush`
+
+    Args:
+        name (str): timer name
+    """
+    if _stream is None:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def count(name, n=1):
+    """
+    Adds `n` to a counter, the counters are reset by `flush`
+
+    Args:
+        name (str): counter name
+        n (int): increment
+    """
+    if _stream is None:
+        return
+    _counters[name] = _counters.get(name, 0) + n
+
+
+def flush(event, **fields):
+    """
+    Writes the timers and counters summed up since the last flush as one
+    record, e.g. once per epoch, and resets them
+
+    Args:
+        event (str): record type
+        fields: extra values of the record
+    """
+    if _stream is None:
+        return
+    timers = {name: {'count': total[0], 'seconds': total[1]} for name, total in _timers.items()}
+    emit(event, timers=timers, counters=dict(_counters), **fields)
+    _timers.clear()
+    _counters.clear()
+
+
+def start_profile():
+    """
+    Starts profiling the current process with cProfile
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = cProfile.Profile()
+    _profiler.enable()
+
+
+def stop_profile(path):
+    """
+    Stops profiling and dumps the stats, a `.txt` summary sorted by
+    cumulative time is written next to them
+
+    Args:
+        path (str): output of the binary stats, readable by `pstats`
+    """
+    global _profiler
+    if _profiler is None:
+        return
+    _profiler.disable()
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    _profiler.dump_stats(path)
+    with open(path + '.txt', 'w') as f:
+        pstats.Stats(_profiler, stream=f).sort_stats('cumulative').print_stats(50)
+    _profiler = None
+    emit('profile', path=path)
@@ -22,6 +22,195 @@ def get_pos_channel(pos_level_dist):
     return L
 
 
+def build_alias_table(probabilities):
+    """
+    Builds a Walker alias table (Vose's method), so that a discrete
+    distribution can be sampled in O(1) with two uniform draws
+
+    Args:
+        probabilities (:obj:`np.array`): (k, ) probabilities of `k` outcomes
+
+    Returns:
+        prob (:obj:`np.array`): (k, ) probability to keep outcome `k`
+        alias (:obj:`np.array`): (k, ) outcome to take instead of `k`
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    n_outcomes = len(probabilities)
+    scaled = probabilities * n_outcomes / probabilities.sum()
+    prob = np.ones(n_outcomes)
+    alias = np.arange(n_outcomes)
+
+    small = [k for k in range(n_outcomes) if scaled[k] < 1.0]
+    large = [k for k in range(n_outcomes) if scaled[k] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+
+    return prob, alias
+
+
+def get_pos_channel_sampler(pos_level_dist):
+    """
+    Compiles the positive channel sampling distribution into an alias table
+
+    Args:
+        pos_level_dist (dict): positive channel sampling distribution
+
+    Returns:
+        sampler (dict): `levels`, `prob` and `alias` arrays
+    """
+    levels = np.array(list(pos_level_dist.keys()))
+    prob, alias = build_alias_table(list(pos_level_dist.values()))
+
+    return {'levels': levels, 'prob': prob, 'alias': alias}
+
+
+def draw_pos_channels(sampler, size):
+    """
+    Samples positive feedback channels from a compiled alias table
+
+    Args:
+        sampler (dict): alias table from `get_pos_channel_sampler`
+        size (int): no. of channels to draw
+
+    Returns:
+        L (:obj:`np.array`): (size, ) positive feedback channels
+    """
+    k = (np.random.random(size) * len(sampler['levels'])).astype(np.int64)
+    keep = np.random.random(size) < sampler['prob'][k]
+
+    return sampler['levels'][np.where(keep, k, sampler['alias'][k])]
+
+
+def get_neg_channel_sampler(user_reps, m):
+    """
+    Compiles every user's negative channel distribution (including the
+    unobserved channel `-1`) into alias tables stored as flat arrays,
+    user `u` owns the entries `offsets[u]:offsets[u] + sizes[u]`
+
+    Args:
+        user_reps (dict): representations for all `m` unique users
+        m (int): no. of unique users in the dataset
+
+    Returns:
+        sampler (dict): flat `levels`, `prob`, `alias` arrays with room
+            to grow (`end` entries in use, `stale` of them left behind by
+            updates) and per-user `offsets`, `sizes`
+    """
+    sampler = {'levels': np.zeros(0, dtype=np.int64), 'prob': np.zeros(0),
+               'alias': np.zeros(0, dtype=np.int64),
+               'offsets': np.zeros(0, dtype=np.int64), 'sizes': np.zeros(0, dtype=np.int64),
+               'end': 0, 'stale': 0}
+    update_neg_channel_sampler(sampler, user_reps, range(m))
+
+    return sampler
+
+
+def _grow(array, size):
+    # geometric growth, appending k entries costs O(k) amortized
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def update_neg_channel_sampler(sampler, user_reps, users):
+    """
+    (Re)compiles the negative channel alias tables of the given users, a
+    table of unchanged size is overwritten in place, other tables are
+    appended and the users repointed. The flat arrays are compacted once
+    more than half of their entries are stale, so the cost stays
+    proportional to the updated tables
+
+    Args:
+        sampler (dict): alias tables from `get_neg_channel_sampler`,
+            updated in place
+        user_reps (dict): user representations
+        users ([int]): user IDs to (re)compile
+    """
+    users = list(users)
+    if not users:
+        return
+    # samplers pickled before the arrays could grow are full and compact
+    sampler.setdefault('end', len(sampler['levels']))
+    sampler.setdefault('stale', 0)
+    m = max(users) + 1
+    if m > len(sampler['offsets']):
+        sampler['offsets'] = _grow(sampler['offsets'], m)
+        sampler['sizes'] = _grow(sampler['sizes'], m)
+
+    for u in users:
+        dist = user_reps[u]['neg_channel_dist']
+        levels = np.array(list(dist.keys()))
+        user_prob, user_alias = build_alias_table(list(dist.values()))
+        size = len(dist)
+        if sampler['sizes'][u] == size:
+            offset = sampler['offsets'][u]
+        else:
+            sampler['stale'] += sampler['sizes'][u]
+            offset = sampler['end']
+            sampler['end'] += size
+            for key in ['levels', 'prob', 'alias']:
+                sampler[key] = _grow(sampler[key], sampler['end'])
+        if np.result_type(sampler['levels'], levels) != sampler['levels'].dtype:
+            sampler['levels'] = sampler['levels'].astype(np.result_type(sampler['levels'], levels))
+
+        sampler['levels'][offset:offset + size] = levels
+        sampler['prob'][offset:offset + size] = user_prob
+        sampler['alias'][offset:offset + size] = user_alias + offset
+        sampler['offsets'][u], sampler['sizes'][u] = offset, size
+
+    if sampler['stale'] > sampler['end'] // 2:
+        compact_neg_channel_sampler(sampler)
+
+
+def compact_neg_channel_sampler(sampler):
+    """
+    Drops the stale entries of the flat alias table arrays, every user's
+    table moves to the position of a fresh compilation
+
+    Args:
+        sampler (dict): alias tables from `get_neg_channel_sampler`,
+            updated in place
+    """
+    sizes = sampler['sizes']
+    offsets = np.cumsum(sizes) - sizes
+    shift = np.repeat(sampler['offsets'] - offsets, sizes)
+    entries = np.arange(sizes.sum()) + shift
+
+    sampler['levels'] = sampler['levels'][entries]
+    sampler['prob'] = sampler['prob'][entries]
+    sampler['alias'] = sampler['alias'][entries] - shift
+    sampler['offsets'] = offsets
+    sampler['end'], sampler['stale'] = int(sizes.sum()), 0
+
+
+def draw_neg_channels(sampler, users):
+    """
+    Conditional negative level sampler over a batch of users, draws from
+    the compiled per-user alias tables in O(1) each
+
+    Args:
+        sampler (dict): alias tables from `get_neg_channel_sampler`
+        users (:obj:`np.array`): (b, ) user IDs
+
+    Returns:
+        N (:obj:`np.array`): (b, ) negative feedback channels
+    """
+    users = np.asarray(users)
+    k = sampler['offsets'][users] + \
+        (np.random.random(len(users)) * sampler['sizes'][users]).astype(np.int64)
+    keep = np.random.random(len(users)) < sampler['prob'][k]
+
+    return sampler['levels'][np.where(keep, k, sampler['alias'][k])]
+
+
 def get_pos_user_item(L, train_inter_pos_dict):
     """
     Sample user u, positive feedback channel and item
@@ -60,7 +249,7 @@ def get_neg_channel(user_rep):
 
 
 def get_neg_item(user_rep, N, n, u, i, pos_level_dist, train_inter_pos_dict,
-                 mode='uniform'):
+                 mode='uniform', pos_channel_sampler=None):
     """
     Samples the negative item `j` to complete the update triplet `(u, i, j)
 
@@ -81,6 +270,8 @@ def get_neg_item(user_rep, N, n, u, i, pos_level_dist, train_inter_pos_dict,
         train_inter_pos_dict (dict): collection of all (user, item) interaction
             tuples for each positive feedback channel
         mode (str): `uniform` or `non-uniform` mode to sample negative items
+        pos_channel_sampler (dict): alias table of `pos_level_dist`, used
+            instead of the dict when given
 
     Returns:
         j (int): sampled negative item ID
@@ -97,7 +288,8 @@ def get_neg_item(user_rep, N, n, u, i, pos_level_dist, train_inter_pos_dict,
 
         elif mode == 'non-uniform':
             # sample item non-uniformly from unobserved channel
-            L = get_pos_channel(pos_level_dist)
+            L = get_pos_channel(pos_level_dist) if pos_channel_sampler is None \
+                else draw_pos_channels(pos_channel_sampler, 1)[0]
             pos_channel_interactions = train_inter_pos_dict[L]
             n_pos_interactions = len(pos_channel_interactions)
             pick_trials = 0  # ensure sampling despite
@@ -111,10 +303,59 @@ def get_neg_item(user_rep, N, n, u, i, pos_level_dist, train_inter_pos_dict,
                 if pick_trials == 10:
                     # Ensures that while-loop terminates if sampled L does
                     # not provide properly different feedback
-                    L = get_pos_channel(pos_level_dist)
+                    L = get_pos_channel(pos_level_dist) if pos_channel_sampler is None \
+                        else draw_pos_channels(pos_channel_sampler, 1)[0]
                     pos_channel_interactions = train_inter_pos_dict[L]
                     n_pos_interactions = len(pos_channel_interactions)
 
             j = i_other
 
-    return j
\ No newline at end of file
+    return j
+
+def get_neg_channel_cdf(channels, counts, mean_ratings, beta):
+    """
+    Compiles the negative channel distributions of all users from their
+    per-channel rating counts, the vectorized counterpart of the
+    `neg_channel_dist` of `get_user_rep` when there are no user_reps
+
+    Args:
+        channels (:obj:`np.array`): (C, ) rating values of the channels
+        counts (:obj:`np.array`): (m, C) no. of ratings per user and channel
+        mean_ratings (:obj:`np.array`): (m, ) mean rating per user,
+            `nan` for users without training ratings
+        beta (float): share of unobserved feedback within the overall
+            negative feedback
+
+    Returns:
+        sampler (dict): `levels` (C + 1, ) the channels and the unobserved
+            channel `-1`, `cdf` (m, C + 1) cumulative probabilities
+    """
+    negative = channels[None, :] < mean_ratings[:, None]
+    neg_counts = np.where(negative, counts, 0)
+    nominators = neg_counts / channels[None, :].astype(np.float64)
+    denominators = nominators.sum(axis=1, keepdims=True)
+    observed = neg_counts.sum(axis=1, keepdims=True) > 0
+
+    # if there is no negative feedback, only unobserved remains
+    dist = np.where(observed, nominators / np.where(denominators > 0, denominators, 1) * (1 - beta), 0.0)
+    dist = np.hstack([dist, np.where(observed, beta, 1.0)])
+
+    return {'levels': np.append(channels, -1), 'cdf': np.cumsum(dist, axis=1)}
+
+
+def draw_neg_channels_cdf(sampler, users):
+    """
+    Conditional negative level sampler over a batch of users by inversion
+    of the per-user cumulative distributions
+
+    Args:
+        sampler (dict): distributions from `get_neg_channel_cdf`
+        users (:obj:`np.array`): (b, ) user IDs
+
+    Returns:
+        N (:obj:`np.array`): (b, ) negative feedback channels
+    """
+    cdf = sampler['cdf'][users]
+    draws = np.random.random(len(users)) * cdf[:, -1]
+
+    return sampler['levels'][(cdf <= draws[:, None]).sum(axis=1)]
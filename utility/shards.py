@@ -0,0 +1,324 @@
+'''
+Out-of-core datasets.
+The rating files are streamed in chunks into user-sorted, memory-mapped
+item shards and per-user statistics, so that the interactions never have
+to fit in memory. Only the O(users) statistics stay resident.
+'''
+import os
+import json
+import numpy as np
+import pandas as pd
+from utility.sampling import draw_pos_channels
+
+STORE_VERSION = 2
+
+
+def read_chunks(filename, chunk_rows):
+    return pd.read_csv(filename, sep=',', skipinitialspace=True, names=['user', 'item', 'rating'],
+                       chunksize=chunk_rows)
+
+
+def ingest_ratings(path, store_dir, shard_users=100000, chunk_rows=1000000):
+    """
+    Streams `path.train.rating` and `path.test.rating` into a shard store
+
+    Pass 1 collects the raw IDs and rating values. Pass 2 maps every chunk
+    to dense indices, sums up the per-user channel counts and ratings and
+    spills the rows to one temporary file per shard. Pass 3 sorts every
+    shard by (user, channel) and saves its items. Memory is bounded by the
+    per-user statistics, one chunk and one shard
+
+    Args:
+        path (str): rating files without the `.train.rating` suffix
+        store_dir (str): output directory
+        shard_users (int): no. of users per shard
+        chunk_rows (int): no. of rows per read chunk
+
+    Returns:
+        meta (dict): store metadata, also written to `meta.json`
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    sources = [path + ".train.rating", path + ".test.rating"]
+
+    # pass 1: dense indices follow the sorted raw IDs, like `Data`
+    user_ids, item_ids = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    ratings = np.zeros(0, dtype=np.int64)
+    for source in sources:
+        for chunk in read_chunks(source, chunk_rows):
+            user_ids = np.union1d(user_ids, chunk['user'].values)
+            item_ids = np.union1d(item_ids, chunk['item'].values)
+            if source == sources[0]:
+                ratings = np.union1d(ratings, chunk['rating'].values)
+    num_users, num_items = len(user_ids), len(item_ids)
+    channels = ratings[::-1]
+    num_channels = len(channels)
+
+    # pass 2: per-user statistics, rows spilled to their shard
+    counts = np.zeros((num_users, num_channels), dtype=np.int64)
+    rating_sums = np.zeros(num_users)
+    num_shards = max(1, -(-num_users // shard_users))
+    spills = [os.path.join(store_dir, 'items_%d.tmp' % k) for k in range(num_shards)]
+    for spill in spills:
+        open(spill, 'wb').close()
+
+    num_train = 0
+    for chunk in read_chunks(sources[0], chunk_rows):
+        users = np.searchsorted(user_ids, chunk['user'].values)
+        items = np.searchsorted(item_ids, chunk['item'].values)
+        levels = num_channels - 1 - np.searchsorted(ratings, chunk['rating'].values)
+        np.add.at(counts, (users, levels), 1)
+        np.add.at(rating_sums, users, chunk['rating'].values)
+        num_train += len(users)
+
+        shards = users // shard_users
+        order = np.argsort(shards, kind='stable')
+        bounds = np.searchsorted(shards[order], np.arange(num_shards + 1))
+        rows = np.stack([users, levels, items], axis=1)[order]
+        for k in np.flatnonzero(np.diff(bounds)):
+            with open(spills[k], 'ab') as f:
+                rows[bounds[k]:bounds[k + 1]].tofile(f)
+
+    # pass 3: sort every shard, the file order is kept within (user, channel)
+    item_dtype = np.int32 if num_items < 2 ** 31 else np.int64
+    num_pairs = 0
+    for k, spill in enumerate(spills):
+        rows = np.fromfile(spill, dtype=np.int64).reshape(-1, 3)
+        # distinct positively rated (user, item) pairs, the shards hold all rows of their users
+        positive = rows[channels[rows[:, 1]] > 0]
+        num_pairs += len(np.unique(positive[:, 0] * num_items + positive[:, 2]))
+        order = np.lexsort((rows[:, 1], rows[:, 0]))
+        np.save(os.path.join(store_dir, 'items_%d.npy' % k), rows[order, 2].astype(item_dtype))
+        os.remove(spill)
+
+    test_items = np.full(num_users, -1, dtype=np.int64)
+    for chunk in read_chunks(sources[1], chunk_rows):
+        test_items[np.searchsorted(user_ids, chunk['user'].values)] = \
+            np.searchsorted(item_ids, chunk['item'].values)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_ratings = rating_sums / counts.sum(axis=1)
+    np.save(os.path.join(store_dir, 'user_ids.npy'), user_ids)
+    np.save(os.path.join(store_dir, 'item_ids.npy'), item_ids)
+    np.save(os.path.join(store_dir, 'counts.npy'), counts)
+    np.save(os.path.join(store_dir, 'mean_ratings.npy'), mean_ratings)
+    np.save(os.path.join(store_dir, 'test_items.npy'), test_items)
+
+    # written last, a store without it is incomplete
+    meta = {'version': STORE_VERSION, 'num_users': num_users, 'num_items': num_items,
+            'num_train': num_train, 'num_pairs': num_pairs, 'channels': channels.tolist(),
+            'shard_users': shard_users, 'num_shards': num_shards}
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    return meta
+
+
+class ShardedData(object):
+    """
+    Read-only dataset over a shard store from `ingest_ratings`
+
+    The training items of all users form one logical array sorted by
+    (user, channel), cut into shards of `shard_users` users that are
+    memory-mapped. Rows are addressed globally, user `u` owns the rows
+    `indptr[u]:indptr[u + 1]` and the run of channel `c` starts at
+    `channel_offsets[u, c]`
+    """
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.num_users, self.num_items = meta['num_users'], meta['num_items']
+        self.num_train, self.shard_users = meta['num_train'], meta['shard_users']
+        # no. of samples per epoch, like the keys of `Data.trainMatrix`
+        self.num_pairs = meta['num_pairs']
+        self.channels = np.array(meta['channels'])
+
+        self.user_ids = np.load(os.path.join(store_dir, 'user_ids.npy'))
+        self.item_ids = np.load(os.path.join(store_dir, 'item_ids.npy'))
+        self.counts = np.load(os.path.join(store_dir, 'counts.npy'))
+        self.mean_ratings = np.load(os.path.join(store_dir, 'mean_ratings.npy'))
+        self.testItems = np.load(os.path.join(store_dir, 'test_items.npy'))
+        self._user_index = None
+
+        self.indptr = np.concatenate([[0], np.cumsum(self.counts.sum(axis=1))])
+        self.channel_offsets = self.indptr[:-1, None] + np.cumsum(self.counts, axis=1) - self.counts
+        shard_starts = np.minimum(np.arange(meta['num_shards'] + 1) * self.shard_users, self.num_users)
+        self.shard_rows = self.indptr[shard_starts]
+        self.shards = [np.load(os.path.join(store_dir, 'items_%d.npy' % k), mmap_mode='r')
+                       for k in range(meta['num_shards'])]
+
+        self.pos_cum = self.get_pos_cum(np.ones(self.num_users, dtype=bool))
+        self.own_pos_cum = self.pos_cum
+
+    def get_pos_cum(self, owned):
+        # positive rows (rating >= user mean) per channel, cumulated over the owned users
+        positive = (self.channels[None, :] >= self.mean_ratings[:, None]) & owned[:, None]
+        return np.cumsum(np.where(positive, self.counts, 0), axis=0).T.copy()
+
+    def partition_users(self, owned):
+        """
+        Restricts the positive pairs of a training batch to the owned users,
+        e.g. the user partition of a data-parallel trainer, the unobserved
+        negatives are still drawn from the positives of all users
+
+        Args:
+            owned (:obj:`np.array`): (num_users, ) boolean mask
+        """
+        self.own_pos_cum = self.get_pos_cum(owned)
+
+    @property
+    def user_index(self):
+        # built on demand, only `recommend` looks raw user IDs up
+        if self._user_index is None:
+            self._user_index = dict(zip(self.user_ids.tolist(), range(self.num_users)))
+        return self._user_index
+
+    def save_id_map(self, filename):
+        np.savez(filename, user_ids=self.user_ids, item_ids=self.item_ids)
+
+    @staticmethod
+    def load_id_map(filename):
+        id_map = np.load(filename)
+        return id_map['user_ids'], id_map['item_ids']
+
+    def set_id_map(self, id_map):
+        """
+        The shards are written in the order of the store's own ID map, a
+        checkpoint with another map needs a new ingest
+
+        Returns:
+            reindexed (bool): always `False`
+        """
+        known_users, known_items = id_map
+        if not (np.array_equal(self.user_ids[:len(known_users)], known_users) and
+                np.array_equal(self.item_ids[:len(known_items)], known_items)):
+            raise ValueError("The shard store is indexed differently from the checkpoint, re-ingest the dataset")
+        return False
+
+    def get_pos_channel_counts(self, own=False):
+        """
+        Args:
+            own (bool): count the rows of the owned users only
+
+        Returns:
+            (:obj:`np.array`, :obj:`np.array`): rating values of the positive
+                channels with positive rows, and their no. of rows
+        """
+        totals = (self.own_pos_cum if own else self.pos_cum)[:, -1]
+        present = totals > 0
+        return self.channels[present], totals[present]
+
+    def channel_levels(self, values):
+        # channel index of rating values, the channels are in descending order
+        return np.searchsorted(-self.channels, -np.asarray(values))
+
+    def user_items(self, user):
+        k = user // self.shard_users
+        begin = self.indptr[user] - self.shard_rows[k]
+        return self.shards[k][begin:begin + self.indptr[user + 1] - self.indptr[user]]
+
+    def items_at(self, rows):
+        """
+        Args:
+            rows (:obj:`np.array`): (b, ) global row indices
+
+        Returns:
+            items (:obj:`np.array`): (b, ) items of the rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        items = np.empty(len(rows), dtype=np.int64)
+        shards = np.searchsorted(self.shard_rows, rows, side='right') - 1
+        for k in np.unique(shards):
+            mask = shards == k
+            items[mask] = self.shards[k][rows[mask] - self.shard_rows[k]]
+        return items
+
+    def rated(self, users, items):
+        """
+        Args:
+            users (:obj:`np.array`): (b, ) user IDs
+            items (:obj:`np.array`): (b, ) item IDs
+
+        Returns:
+            rated (:obj:`np.array`): (b, ) whether user `b` rated item `b`
+        """
+        users = np.asarray(users, dtype=np.int64)
+        lengths = self.indptr[users + 1] - self.indptr[users]
+        # the training rows of all users in one gather, compared against their candidate
+        owner = np.repeat(np.arange(len(users)), lengths)
+        rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + \
+            np.repeat(self.indptr[users], lengths)
+        hits = self.items_at(rows) == np.asarray(items)[owner]
+        return np.bincount(owner[hits], minlength=len(users)) > 0
+
+    def draw_pos_pairs(self, levels, own=False):
+        """
+        Samples positive (user, item) pairs uniformly within their channel,
+        the counterpart of `get_pos_user_item`
+
+        Args:
+            levels (:obj:`np.array`): (b, ) channel indices
+            own (bool): sample from the owned users only
+
+        Returns:
+            users (:obj:`np.array`): (b, ) user IDs
+            items (:obj:`np.array`): (b, ) positive item IDs
+        """
+        levels = np.asarray(levels)
+        pos_cum = self.own_pos_cum if own else self.pos_cum
+        users = np.empty(len(levels), dtype=np.int64)
+        rows = np.empty(len(levels), dtype=np.int64)
+        for c in np.unique(levels):
+            mask = levels == c
+            picks = np.random.randint(0, pos_cum[c, -1], size=mask.sum())
+            u = np.searchsorted(pos_cum[c], picks, side='right')
+            users[mask] = u
+            rows[mask] = self.channel_offsets[u, c] + picks - (pos_cum[c, u] - self.counts[u, c])
+        return users, self.items_at(rows)
+
+    def draw_neg_items(self, users, neg_channels, mode='uniform', pos_channel_sampler=None):
+        """
+        Samples the negative items of a batch, the counterpart of
+        `get_neg_item`: uniform within an explicit negative channel, and
+        from the unobserved channel either uniform over the items or
+        through the positives of other users
+
+        Args:
+            users (:obj:`np.array`): (b, ) user IDs
+            neg_channels (:obj:`np.array`): (b, ) negative channels, `-1` is
+                the unobserved channel
+            mode (str): `uniform` or `non-uniform` mode to sample unobserved items
+            pos_channel_sampler (dict): alias table of the positive channels
+
+        Returns:
+            items (:obj:`np.array`): (b, ) negative item IDs
+        """
+        items = np.empty(len(users), dtype=np.int64)
+        explicit = np.flatnonzero(neg_channels != -1)
+        if len(explicit):
+            u, c = users[explicit], self.channel_levels(neg_channels[explicit])
+            rows = self.channel_offsets[u, c] + (np.random.random(len(u)) * self.counts[u, c]).astype(np.int64)
+            items[explicit] = self.items_at(rows)
+
+        # rejection rounds over the unobserved draws that are still pending
+        pending = np.flatnonzero(neg_channels == -1)
+        levels = self.channel_levels(draw_pos_channels(pos_channel_sampler, len(pending))) \
+            if mode == 'non-uniform' else None
+        trials = 0
+        while len(pending):
+            if mode == 'uniform':
+                candidates = np.random.randint(0, self.num_items, size=len(pending))
+                accepted = ~self.rated(users[pending], candidates)
+            else:
+                others, candidates = self.draw_pos_pairs(levels)
+                accepted = (others != users[pending]) & ~self.rated(users[pending], candidates)
+            items[pending[accepted]] = candidates[accepted]
+            pending = pending[~accepted]
+            if levels is not None:
+                levels = levels[~accepted]
+                trials += 1
+                if trials == 10:
+                    # a channel without properly different feedback is drawn again
+                    levels = self.channel_levels(draw_pos_channels(pos_channel_sampler, len(pending)))
+
+        return items